@@ -1,11 +1,17 @@
+import io
 import os
-from sqlalchemy import select, func, and_
+import time
+from sqlalchemy import select, func, and_, text, tuple_
+import numpy as np
 import pandas as pd
 import asyncio
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 from dotenv import load_dotenv
-from sqlalchemy import Column, Integer, String, Numeric, Date, DateTime
+from sqlalchemy import Column, Integer, String, Numeric, Date, DateTime, Float, ForeignKey, UniqueConstraint, Index
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import column_property, declarative_base
 from datetime import datetime, date
 
 load_dotenv()
@@ -16,173 +22,847 @@ DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 
 db_url = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Реплика только для чтения (postgresql+asyncpg://...): на неё уходят чтения API, чтобы загрузка
+# не отнимала у них соединения и ресурсы основной БД. Пусто — всё читается из основной БД.
+DB_REPLICA_URL = os.getenv("DB_REPLICA_URL", "")
+
+# Пул соединений (отдельный для основной БД и для реплики)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+# Сколько секунд ждать свободное соединение, когда пул занят
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# Проверять соединение перед выдачей из пула (переживает рестарт БД и обрывы через pgbouncer/NAT)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")
+# Пересоздавать соединения старше стольких секунд (-1 — не пересоздавать)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+# Сколько секунд после загрузки ждать, пока реплика догонит основную БД, и как часто её опрашивать
+DB_REPLICA_WAIT = float(os.getenv("DB_REPLICA_WAIT", 300))
+DB_REPLICA_POLL = float(os.getenv("DB_REPLICA_POLL", 0.2))
+
+# Секционирование spimex_trading_results по месяцам (PARTITION BY RANGE (date)).
+# Учитывается только при создании таблицы, существующая таблица не перестраивается.
+DB_PARTITIONED = os.getenv("DB_PARTITIONED", "0").lower() in ("1", "true", "yes")
+# На сколько месяцев вперёд create_tables заранее создаёт секции
+DB_PARTITIONS_AHEAD = int(os.getenv("DB_PARTITIONS_AHEAD", 2))
+# Нормализованная схема: справочник инструментов spimex_instruments и узкая таблица фактов
+# spimex_trading_results (id, exchange_product_id, volume, total, count, date). Как и секционирование,
+# учитывается только при создании таблиц.
+DB_NORMALIZED = os.getenv("DB_NORMALIZED", "0").lower() in ("1", "true", "yes")
+
+# Поля, которые определяются exchange_product_id (в нормализованной схеме живут в справочнике)
+INSTRUMENT_COLUMNS = ('exchange_product_name', 'oil_id', 'delivery_basis_id', 'delivery_basis_name',
+                      'delivery_type_id')
 
 Base = declarative_base()
 
-class SpimexTradingResult(Base):
-    __tablename__ = 'spimex_trading_results'
-    id = Column(Integer, primary_key=True)
-    exchange_product_id = Column(String)
-    exchange_product_name = Column(String)
-    oil_id = Column(String)
-    delivery_basis_id = Column(String)
-    delivery_basis_name = Column(String)
-    delivery_type_id = Column(String)
+if DB_NORMALIZED:
+    class SpimexInstrument(Base):
+        """Справочник инструментов: строка на exchange_product_id"""
+        __tablename__ = 'spimex_instruments'
+        __table_args__ = (
+            # фильтры get_dynamics и get_trading_results
+            Index('ix_instrument_oil', 'oil_id'),
+            Index('ix_instrument_basis', 'delivery_basis_id'),
+            Index('ix_instrument_type', 'delivery_type_id'),
+        )
+        exchange_product_id = Column(String, primary_key=True)
+        exchange_product_name = Column(String)
+        oil_id = Column(String)
+        delivery_basis_id = Column(String)
+        delivery_basis_name = Column(String)
+        delivery_type_id = Column(String)
+
+    class SpimexTradingFact(Base):
+        """Узкая таблица фактов: инструмент, дата и числа сделки"""
+        __tablename__ = 'spimex_trading_results'
+        __table_args__ = (
+            # заодно индекс для соединения со справочником по (exchange_product_id, date)
+            UniqueConstraint('exchange_product_id', 'date', name='uq_spimex_product_date'),
+            Index('ix_spimex_date', 'date'),
+            {'postgresql_partition_by': 'RANGE (date)'} if DB_PARTITIONED else {},
+        )
+        id = Column(Integer, primary_key=True, autoincrement=True)
+        exchange_product_id = Column(String, ForeignKey('spimex_instruments.exchange_product_id'))
+        volume = Column(Numeric)
+        total = Column(Numeric)
+        count = Column(Integer)
+        date = Column(Date, primary_key=DB_PARTITIONED)
+        created_on = Column(DateTime, default=datetime.utcnow)
+        updated_on = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    class SpimexTradingResult(Base):
+        """Прежняя широкая строка поверх соединения фактов со справочником: запросы и API не меняются"""
+        __table__ = SpimexTradingFact.__table__.join(SpimexInstrument.__table__)
+        exchange_product_id = column_property(SpimexTradingFact.__table__.c.exchange_product_id,
+                                              SpimexInstrument.__table__.c.exchange_product_id)
+
+    # таблица, в которую пишутся строки торгов (и которая секционируется)
+    TRADING_TABLE = SpimexTradingFact.__table__
+else:
+    class SpimexTradingResult(Base):
+        __tablename__ = 'spimex_trading_results'
+        __table_args__ = (
+            UniqueConstraint('exchange_product_id', 'date', name='uq_spimex_product_date'),
+            # ORDER BY date / DISTINCT date / date BETWEEN
+            Index('ix_spimex_date', 'date'),
+            # фильтры get_dynamics и get_trading_results + сортировка по дате
+            Index('ix_spimex_oil_date', 'oil_id', 'date'),
+            Index('ix_spimex_basis_date', 'delivery_basis_id', 'date'),
+            Index('ix_spimex_type_date', 'delivery_type_id', 'date'),
+            {'postgresql_partition_by': 'RANGE (date)'} if DB_PARTITIONED else {},
+        )
+        id = Column(Integer, primary_key=True, autoincrement=True)
+        exchange_product_id = Column(String)
+        exchange_product_name = Column(String)
+        oil_id = Column(String)
+        delivery_basis_id = Column(String)
+        delivery_basis_name = Column(String)
+        delivery_type_id = Column(String)
+        volume = Column(Numeric)
+        total = Column(Numeric)
+        count = Column(Integer)
+        # у секционированной таблицы ключ секционирования обязан входить в первичный ключ
+        date = Column(Date, primary_key=DB_PARTITIONED)
+        created_on = Column(DateTime, default=datetime.utcnow)
+        updated_on = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    TRADING_TABLE = SpimexTradingResult.__table__
+
+
+class SpimexDailyAggregate(Base):
+    """Дневная сводка по date × oil_id × delivery_basis_id × delivery_type_id (обновляется при загрузке)"""
+    __tablename__ = 'spimex_daily_aggregates'
+    date = Column(Date, primary_key=True)
+    oil_id = Column(String, primary_key=True)
+    delivery_basis_id = Column(String, primary_key=True)
+    delivery_type_id = Column(String, primary_key=True)
     volume = Column(Numeric)
     total = Column(Numeric)
     count = Column(Integer)
-    date = Column(Date)
-    created_on = Column(DateTime, default=datetime.utcnow)
     updated_on = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
-engine = create_async_engine(db_url, echo=False)
+# Измерения сводки, по которым можно группировать и фильтровать
+AGGREGATE_DIMENSIONS = ('oil_id', 'delivery_basis_id', 'delivery_type_id')
+
+
+# Колонки, которые отдаёт API, в порядке полей ответа. Numeric приводится к float прямо в запросе,
+# поэтому строки можно сериализовать без ORM-объектов и поштучной конвертации Decimal.
+API_COLUMNS = (
+    SpimexTradingResult.id,
+    SpimexTradingResult.exchange_product_id,
+    SpimexTradingResult.exchange_product_name,
+    SpimexTradingResult.oil_id,
+    SpimexTradingResult.delivery_basis_id,
+    SpimexTradingResult.delivery_basis_name,
+    SpimexTradingResult.delivery_type_id,
+    SpimexTradingResult.volume.cast(Float).label('volume'),
+    SpimexTradingResult.total.cast(Float).label('total'),
+    SpimexTradingResult.count,
+    SpimexTradingResult.date,
+)
+
+
+POOL_OPTIONS = dict(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                    pool_pre_ping=DB_POOL_PRE_PING, pool_recycle=DB_POOL_RECYCLE)
+
+engine = create_async_engine(db_url, echo=False, **POOL_OPTIONS)
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 
+# Без реплики read_engine — это тот же engine
+read_engine = create_async_engine(DB_REPLICA_URL, echo=False, **POOL_OPTIONS) if DB_REPLICA_URL else engine
+replica_session = async_sessionmaker(read_engine, expire_on_commit=False)
+
+# Внутри primary_reads() чтения идут в основную БД
+_primary_reads = ContextVar('primary_reads', default=False)
+
+
+def read_session():
+    """Сессия для чтений API: реплика (если задан DB_REPLICA_URL), внутри primary_reads() — основная БД"""
+    return async_session() if _primary_reads.get() else replica_session()
+
+
+async def wait_for_replica(timeout: float = DB_REPLICA_WAIT, poll: float = DB_REPLICA_POLL) -> bool:
+    """
+    Ждёт, пока реплика применит WAL основной БД на текущий момент (все уже закоммиченные загрузки).
+    Событие загрузки публикуется только после этого: иначе запросы API прочитали бы с реплики
+    старые строки и закэшировали их уже под новой версией данных. True — реплика догнала
+    (или её нет), False — не догнала за timeout секунд.
+    """
+    if read_engine is engine:
+        return True
+    async with engine.connect() as conn:
+        target = (await conn.execute(text("SELECT pg_current_wal_lsn()"))).scalar()
+    deadline = time.monotonic() + timeout
+    async with read_engine.connect() as conn:
+        while True:
+            # не standby (реплика указывает на саму основную БД) — ждать нечего
+            caught_up = (await conn.execute(
+                text("SELECT coalesce(pg_last_wal_replay_lsn() >= CAST(:target AS pg_lsn), NOT pg_is_in_recovery())"),
+                {"target": target},
+            )).scalar()
+            if caught_up:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(poll)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Читать из основной БД, а не из реплики: сразу после загрузки реплика может ещё отставать,
+    и прогрев кэша не должен сохранить старые данные.
+    """
+    token = _primary_reads.set(True)
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+# Сколько строк отправлять одним INSERT ... ON CONFLICT
+BULK_BATCH_SIZE = 1000
+# Колонки, которые перезаписываются при on_conflict='update'
+UPSERT_COLUMNS = ('exchange_product_name', 'oil_id', 'delivery_basis_id', 'delivery_basis_name',
+                  'delivery_type_id', 'volume', 'total', 'count')
+
 
 async def create_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await _migrate(conn)
+        # сводка только что создана, а данные уже есть — строим её целиком
+        aggregates_empty = not (await conn.execute(select(SpimexDailyAggregate.date).limit(1))).first()
+        if aggregates_empty:
+            await _refresh_daily_aggregates(conn)
+    if DB_PARTITIONED:
+        # текущий месяц и несколько следующих, чтобы ingest не упирался в отсутствующую секцию
+        month = date.today().replace(day=1)
+        months = [month]
+        for _ in range(DB_PARTITIONS_AHEAD):
+            months.append(_next_month(months[-1]))
+        await ensure_partitions(months)
 
 
-async def parse_to_db(filename):
-    try:
-        # Извлекаем дату из имени файла
-        date_str = filename.split('_')[-1][:8]
-        trade_date = datetime.strptime(date_str, '%Y%m%d').date()
+def _next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
 
-        # Читаем Excel файл через pandas (в отдельном потоке)
-        df = await asyncio.to_thread(pd.read_excel, filename, sheet_name='TRADE_SUMMARY', header=None)
 
-        # Поиск стартовой строки с метрическими тоннами
-        metric_ton_row = None
-        for i in range(len(df)):
-            if isinstance(df.iloc[i, 1], str) and 'Единица измерения: Метрическая тонна' in df.iloc[i, 1]:
-                metric_ton_row = i
-                break
+def partition_bounds(day: date):
+    """Имя месячной секции и её границы [from, to) для даты"""
+    month = day.replace(day=1)
+    return f"{TRADING_TABLE.name}_{month:%Y_%m}", month, _next_month(month)
 
-        if metric_ton_row is None:
-            print(f"Не найдена строка с метрическими тоннами в файле {filename}")
-            return
 
-        # Определяем индексы колонок (возможно нужно править под структуру)
-        col_indices = {
-            'code': 1, 'name': 2, 'basis': 3,
-            'volume': 4, 'total': 5, 'count': 14
-        }
+# Секции, которые уже точно существуют (чтобы не выполнять DDL на каждый файл)
+_known_partitions = set()
 
-        data_to_save = []
-        for i in range(metric_ton_row + 3, len(df)):
-            row = df.iloc[i]
 
-            # Пропускаем суммарные строки
-            if isinstance(row[col_indices['code']], str) and ('Итого:' in row[col_indices['code']] or
-                                                              'Итого по секции:' in row[col_indices['code']]):
-                continue
+async def ensure_partitions(dates):
+    """Создаёт недостающие месячные секции для дат (только для секционированной таблицы)."""
+    if not DB_PARTITIONED:
+        return
+    partitions = {partition_bounds(d) for d in dates} - _known_partitions
+    if not partitions:
+        return
+    async with engine.begin() as conn:
+        # параллельные записи файлов могут одновременно создавать одну и ту же секцию
+        await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('spimex_trading_results_partitions'))"))
+        for name, start, end in sorted(partitions):
+            await conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TRADING_TABLE.name} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            ))
+    _known_partitions.update(partitions)
+
+
+async def detach_partition(day: date):
+    """
+    Отсоединяет месячную секцию от таблицы: данные остаются в отдельной таблице,
+    которую можно архивировать (pg_dump) или удалить, не трогая остальные месяцы.
+    """
+    name, _, _ = partition_bounds(day)
+    async with engine.begin() as conn:
+        await conn.execute(text(f"ALTER TABLE {TRADING_TABLE.name} DETACH PARTITION {name}"))
+    _known_partitions.discard(partition_bounds(day))
+    return name
+
+
+def _create_missing_indexes(sync_conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+async def _migrate(conn):
+    # create_all не добавляет ограничения и индексы в уже существующую таблицу,
+    # а ON CONFLICT без уникального ключа не работает
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_spimex_product_date "
+        "ON spimex_trading_results (exchange_product_id, date)"
+    ))
+    await conn.run_sync(_create_missing_indexes)
+    if DB_NORMALIZED:
+        await _backfill_instruments(conn)
+
+
+async def _backfill_instruments(conn):
+    """
+    DB_NORMALIZED=1 поверх существующей широкой таблицы: create_all её не перестраивает, а пустой
+    справочник выбросил бы все старые строки из соединения. Заполняем справочник из широких колонок
+    (последнее по дате название инструмента); сами колонки остаются, но больше не читаются.
+    """
+    has_wide_columns = (await conn.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND column_name = 'exchange_product_name'"
+    ), {"table": TRADING_TABLE.name})).first()
+    if not has_wide_columns:
+        return
+    columns = ", ".join(('exchange_product_id', *INSTRUMENT_COLUMNS))
+    result = await conn.execute(text(
+        f"INSERT INTO {SpimexInstrument.__tablename__} ({columns}) "
+        f"SELECT DISTINCT ON (exchange_product_id) {columns} FROM {TRADING_TABLE.name} "
+        # строки, записанные уже в нормализованном режиме, широкие колонки не заполняют
+        f"WHERE exchange_product_name IS NOT NULL "
+        f"ORDER BY exchange_product_id, date DESC "
+        f"ON CONFLICT (exchange_product_id) DO NOTHING"
+    ))
+    if result.rowcount:
+        print(f"Справочник инструментов дополнен из широкой таблицы: {result.rowcount}")
+
+
+async def migrate():
+    """
+    Доводит существующую БД до текущей схемы (уникальный ключ, индексы, дневная сводка),
+    исходные данные не трогает; сводка пересчитывается целиком.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await _migrate(conn)
+        await _refresh_daily_aggregates(conn)
+        # обновляем статистику, чтобы планировщик сразу начал использовать новые индексы
+        await conn.execute(text("ANALYZE spimex_trading_results"))
+
+
+async def save_records(records, on_conflict: str = 'nothing', batch_size: int = BULK_BATCH_SIZE):
+    """
+    Пакетная запись строк через INSERT ... ON CONFLICT (exchange_product_id, date).
+    on_conflict='nothing' — существующие строки пропускаются, 'update' — перезаписываются.
+    Если что-то изменилось, дневная сводка за даты записей пересчитывается в той же транзакции:
+    строки и сводка фиксируются только вместе.
+    Возвращает словарь со счётчиками inserted / updated / skipped.
+    """
+    if on_conflict not in ('nothing', 'update'):
+        raise ValueError(f"on_conflict must be 'nothing' or 'update', got {on_conflict!r}")
+
+    # Один ключ дважды в одном INSERT ... DO UPDATE вызывает ошибку, оставляем последнюю строку
+    unique = {}
+    for item in records:
+        unique[(item['exchange_product_id'], item['date'])] = item
+    # строки пишутся в порядке ключа, чтобы параллельные записи не блокировали друг друга крест-накрест
+    rows = [unique[key] for key in sorted(unique)]
+
+    await ensure_partitions({item['date'] for item in rows})
+    # Новым строкам проставляем одну метку created_on: по ней в RETURNING отличаем вставленные
+    # строки от обновлённых (xmax у секционированной таблицы в RETURNING недоступен)
+    stamp = datetime.utcnow()
+    rows = [{**item, 'created_on': stamp, 'updated_on': stamp} for item in rows]
+    if DB_NORMALIZED:
+        fact_columns = set(TRADING_TABLE.c.keys())
+        instruments, rows = rows, [{k: v for k, v in item.items() if k in fact_columns} for item in rows]
+    inserted = updated = 0
+    new_instruments = set()
+    async with async_session() as session:
+        if DB_NORMALIZED:
+            new_instruments = await _upsert_instruments(session, instruments, on_conflict == 'update', batch_size)
+        for start in range(0, len(rows), batch_size):
+            stmt = pg_insert(TRADING_TABLE).values(rows[start:start + batch_size])
+            if on_conflict == 'update':
+                set_ = {col: stmt.excluded[col] for col in UPSERT_COLUMNS if col in TRADING_TABLE.c}
+                set_['updated_on'] = stamp
+                stmt = stmt.on_conflict_do_update(index_elements=['exchange_product_id', 'date'], set_=set_)
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=['exchange_product_id', 'date'])
+            result = await session.execute(stmt.returning(TRADING_TABLE.c.created_on))
+            created = result.scalars().all()
+            inserted += sum(1 for value in created if value == stamp)
+            updated += sum(1 for value in created if value != stamp)
+        if inserted or updated:
+            await _refresh_daily_aggregates(session, sorted({item['date'] for item in rows}))
+        await session.commit()
+    _known_instruments.update(new_instruments)
+
+    return {'inserted': inserted, 'updated': updated, 'skipped': len(records) - inserted - updated}
+
+
+# Инструменты, которые уже точно есть в справочнике (чтобы не писать его на каждый файл)
+_known_instruments = set()
+
+
+async def _upsert_instruments(session, rows, update: bool = False, batch_size: int = BULK_BATCH_SIZE):
+    """
+    Строки справочника spimex_instruments для нормализованной схемы. Без update пишутся только
+    инструменты, которых ещё нет в _known_instruments (для остальных ON CONFLICT DO NOTHING);
+    с update названия и коды перезаписываются значениями из файла. Возвращает записанные id —
+    вызывающий добавляет их в _known_instruments после коммита.
+    """
+    unique = {}
+    for item in rows:
+        if update or item['exchange_product_id'] not in _known_instruments:
+            unique[item['exchange_product_id']] = {
+                'exchange_product_id': item['exchange_product_id'],
+                **{col: item[col] for col in INSTRUMENT_COLUMNS},
+            }
+    # одинаковый порядок ключей у всех писателей: параллельные файлы с общими инструментами
+    # блокируют строки в одной последовательности и не попадают в deadlock
+    values = [unique[key] for key in sorted(unique)]
+    table = SpimexInstrument.__table__
+    for start in range(0, len(values), batch_size):
+        stmt = pg_insert(table).values(values[start:start + batch_size])
+        if update:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['exchange_product_id'],
+                set_={col: stmt.excluded[col] for col in INSTRUMENT_COLUMNS},
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=['exchange_product_id'])
+        await session.execute(stmt)
+    return set(unique)
+
+
+async def _refresh_daily_aggregates(conn, dates=None):
+    # conn — соединение или сессия, в транзакции которой идёт пересчёт
+    raw = SpimexTradingResult
+    aggregates = SpimexDailyAggregate.__table__
+    delete_stmt = aggregates.delete()
+    source = (select(raw.date, raw.oil_id, raw.delivery_basis_id, raw.delivery_type_id,
+                     func.sum(raw.volume), func.sum(raw.total), func.sum(raw.count), func.now())
+              .group_by(raw.date, raw.oil_id, raw.delivery_basis_id, raw.delivery_type_id))
+    if dates is not None:
+        delete_stmt = delete_stmt.where(aggregates.c.date.in_(dates))
+        source = source.where(raw.date.in_(dates))
+    await conn.execute(delete_stmt)
+    await conn.execute(aggregates.insert().from_select(
+        ['date', *AGGREGATE_DIMENSIONS, 'volume', 'total', 'count', 'updated_on'], source
+    ))
+
+
+async def refresh_daily_aggregates(dates=None):
+    """
+    Пересчитывает дневную сводку за указанные даты (None — целиком) одним DELETE + INSERT ... SELECT
+    в транзакции, поэтому читатели видят либо старую, либо новую сводку за день.
+    """
+    async with engine.begin() as conn:
+        await _refresh_daily_aggregates(conn, sorted(dates) if dates is not None else None)
+
+
+# Строка-заголовок секции, после которой (через 3 строки) начинаются данные
+METRIC_TON_HEADER = 'Единица измерения: Метрическая тонна'
+# Индексы колонок листа TRADE_SUMMARY (возможно нужно править под структуру)
+COL_INDICES = {
+    'code': 1, 'name': 2, 'basis': 3,
+    'volume': 4, 'total': 5, 'count': 14
+}
+# Целое число в строке — то, что принимает int()
+_INT_STRING = r'^\s*[+-]?\d+\s*$'
+
+
+def trade_date_from_filename(filename):
+    """Извлекаем дату торгов из имени файла oil_xls_YYYYMMDDhhmmss.xls"""
+    date_str = os.path.basename(filename).split('_')[-1][:8]
+    return datetime.strptime(date_str, '%Y%m%d').date()
 
-            if (pd.isna(row[col_indices['code']]) or
-                    (isinstance(row[col_indices['code']], str) and row[col_indices['code']].strip() == '-') or
-                    pd.isna(row[col_indices['count']]) or
-                    (isinstance(row[col_indices['count']], str) and row[col_indices['count']].strip() == '-')):
-                continue
 
-            try:
-                count = int(row[col_indices['count']]) if not pd.isna(row[col_indices['count']]) else 0
-                if count <= 0:
-                    continue
-
-                exchange_product_id = str(row[col_indices['code']]).strip()
-                exchange_product_name = str(row[col_indices['name']]).strip()
-                delivery_basis_name = str(row[col_indices['basis']]).strip()
-
-                volume = float(str(row[col_indices['volume']]).replace(' ', '')) if not pd.isna(
-                    row[col_indices['volume']]) else 0
-                total = float(str(row[col_indices['total']]).replace(' ', '')) if not pd.isna(
-                    row[col_indices['total']]) else 0
-
-                data_to_save.append({
-                    'exchange_product_id': exchange_product_id,
-                    'exchange_product_name': exchange_product_name,
-                    'oil_id': exchange_product_id[:4],
-                    'delivery_basis_id': exchange_product_id[4:7],
-                    'delivery_basis_name': delivery_basis_name,
-                    'delivery_type_id': exchange_product_id[-1],
-                    'volume': volume,
-                    'total': total,
-                    'count': count,
-                    'date': trade_date
-                })
-            except Exception as e:
-                print(f"Ошибка при обработке строки {i + 1}: {e}")
+def read_trade_summary(source):
+    """Читает лист TRADE_SUMMARY (путь к файлу или file-like объект) без заголовков."""
+    return pd.read_excel(source, sheet_name='TRADE_SUMMARY', header=None)
+
+
+def _parse_rows_loop(df, trade_date):
+    """Построчный разбор через df.iloc (исходная реализация)."""
+    col_indices = COL_INDICES
+
+    # Поиск стартовой строки с метрическими тоннами
+    metric_ton_row = None
+    for i in range(len(df)):
+        if isinstance(df.iloc[i, 1], str) and METRIC_TON_HEADER in df.iloc[i, 1]:
+            metric_ton_row = i
+            break
+
+    if metric_ton_row is None:
+        return None
+
+    data_to_save = []
+    for i in range(metric_ton_row + 3, len(df)):
+        row = df.iloc[i]
+
+        # Пропускаем суммарные строки
+        if isinstance(row[col_indices['code']], str) and ('Итого:' in row[col_indices['code']] or
+                                                          'Итого по секции:' in row[col_indices['code']]):
+            continue
+
+        if (pd.isna(row[col_indices['code']]) or
+                (isinstance(row[col_indices['code']], str) and row[col_indices['code']].strip() == '-') or
+                pd.isna(row[col_indices['count']]) or
+                (isinstance(row[col_indices['count']], str) and row[col_indices['count']].strip() == '-')):
+            continue
+
+        try:
+            count = int(row[col_indices['count']]) if not pd.isna(row[col_indices['count']]) else 0
+            if count <= 0:
                 continue
 
+            exchange_product_id = str(row[col_indices['code']]).strip()
+            exchange_product_name = str(row[col_indices['name']]).strip()
+            delivery_basis_name = str(row[col_indices['basis']]).strip()
+
+            volume = float(str(row[col_indices['volume']]).replace(' ', '')) if not pd.isna(
+                row[col_indices['volume']]) else 0
+            total = float(str(row[col_indices['total']]).replace(' ', '')) if not pd.isna(
+                row[col_indices['total']]) else 0
+
+            data_to_save.append({
+                'exchange_product_id': exchange_product_id,
+                'exchange_product_name': exchange_product_name,
+                'oil_id': exchange_product_id[:4],
+                'delivery_basis_id': exchange_product_id[4:7],
+                'delivery_basis_name': delivery_basis_name,
+                'delivery_type_id': exchange_product_id[-1],
+                'volume': volume,
+                'total': total,
+                'count': count,
+                'date': trade_date
+            })
+        except Exception as e:
+            print(f"Ошибка при обработке строки {i + 1}: {e}")
+            continue
+
+    return data_to_save
+
+
+def _strings(col):
+    """Только строковые значения колонки, остальные — NaN (аналог isinstance(x, str))."""
+    if col.dtype != object:
+        return pd.Series(np.nan, index=col.index, dtype=object)
+    return col.where(col.map(type) == str)
+
+
+def _to_float(col):
+    """float(str(x).replace(' ', '')) по всей колонке; NaN -> 0, неразбираемые значения -> NaN."""
+    text = _strings(col)
+    numbers = pd.to_numeric(col.where(text.isna()), errors='coerce')
+    parsed = pd.to_numeric(text.str.replace(' ', '', regex=False), errors='coerce')
+    return numbers.fillna(parsed).where(col.notna(), 0).astype(float)
+
+
+def _parse_rows_vectorized(df, trade_date):
+    """Тот же разбор, что и _parse_rows_loop, но поколоночными операциями pandas/NumPy."""
+    header = _strings(df[COL_INDICES['code']]).str.contains(METRIC_TON_HEADER, regex=False, na=False)
+    header_rows = np.flatnonzero(header.to_numpy(dtype=bool))
+    if not len(header_rows):
+        return None
+
+    body = df.iloc[header_rows[0] + 3:]
+    code = body[COL_INDICES['code']]
+    count_raw = body[COL_INDICES['count']]
+    code_text = _strings(code)
+    count_text = _strings(count_raw)
+
+    # Суммарные строки, пустые коды и прочерки
+    is_total = (code_text.str.contains('Итого:', regex=False, na=False).astype(bool) |
+                code_text.str.contains('Итого по секции:', regex=False, na=False).astype(bool))
+    skip = (is_total | code.isna() | (code_text.str.strip() == '-') |
+            count_raw.isna() | (count_text.str.strip() == '-'))
+
+    # int(): числа усекаются к нулю, строки принимаются только целые
+    count_numbers = np.trunc(pd.to_numeric(count_raw.where(count_text.isna()), errors='coerce'))
+    count_strings = pd.to_numeric(count_text.where(count_text.str.match(_INT_STRING, na=False).astype(bool)),
+                                  errors='coerce')
+    count = count_numbers.fillna(count_strings)
+
+    product_id = code.astype(str).str.strip()
+    volume = _to_float(body[COL_INDICES['volume']])
+    total = _to_float(body[COL_INDICES['total']])
+
+    broken = ~skip & (count.isna() | volume.isna() | total.isna() | (product_id == ''))
+    for i in np.flatnonzero(broken.to_numpy()):
+        print(f"Ошибка при обработке строки {header_rows[0] + 3 + i + 1}: некорректное значение")
+
+    keep = (~skip & ~broken & (count > 0)).to_numpy()
+    product_id = product_id[keep]
+    records = pd.DataFrame({
+        'exchange_product_id': product_id,
+        'exchange_product_name': body[COL_INDICES['name']][keep].astype(str).str.strip(),
+        'oil_id': product_id.str[:4],
+        'delivery_basis_id': product_id.str[4:7],
+        'delivery_basis_name': body[COL_INDICES['basis']][keep].astype(str).str.strip(),
+        'delivery_type_id': product_id.str[-1],
+        'volume': volume[keep],
+        'total': total[keep],
+        'count': count[keep].astype(np.int64),
+    })
+    records['date'] = trade_date
+    return records.to_dict('records')
+
+
+# Движки разбора TRADE_SUMMARY, выбираются параметром parser
+PARSERS = {
+    'loop': _parse_rows_loop,
+    'vectorized': _parse_rows_vectorized,
+}
+
+
+def parse_trade_summary(df, trade_date, parser: str = 'vectorized'):
+    """
+    Извлекает строки торгов из листа TRADE_SUMMARY.
+    Возвращает список словарей для SpimexTradingResult или None, если не найдена секция метрических тонн.
+    parser='loop' — исходный построчный разбор, 'vectorized' — поколоночный (результат совпадает).
+    """
+    if parser not in PARSERS:
+        raise ValueError(f"parser must be one of {sorted(PARSERS)}, got {parser!r}")
+    return PARSERS[parser](df, trade_date)
+
+
+def extract_records(filename, parser: str = 'vectorized', content: bytes = None):
+    """
+    Читает и разбирает файл целиком (синхронно, подходит для запуска в пуле процессов).
+    content — содержимое файла в памяти; тогда с диска ничего не читается, а filename нужен только для даты.
+    """
+    df = read_trade_summary(io.BytesIO(content) if content is not None else filename)
+    return parse_trade_summary(df, trade_date_from_filename(filename), parser=parser)
+
+
+async def parse_to_db(filename, bulk: bool = True, on_conflict: str = 'nothing', parser: str = 'vectorized',
+                      executor=None, write_semaphore=None, content: bytes = None):
+    """
+    Разбирает бюллетень и сохраняет строки в БД.
+    bulk=True — пакетный INSERT ... ON CONFLICT (см. save_records),
+    bulk=False — старый построчный режим SELECT + add.
+    parser — движок разбора листа (см. parse_trade_summary).
+    executor — пул (например ProcessPoolExecutor) для чтения и разбора xls, по умолчанию пул потоков.
+    write_semaphore — ограничение числа одновременных записей в БД.
+    content — уже скачанное содержимое файла (разбирается из памяти).
+    Возвращает счётчики save_records или None, если файл не удалось обработать.
+    """
+    try:
+        # Читаем и разбираем Excel файл вне event loop
+        loop = asyncio.get_running_loop()
+        data_to_save = await loop.run_in_executor(executor, extract_records, filename, parser, content)
+        if data_to_save is None:
+            print(f"Не найдена строка с метрическими тоннами в файле {filename}")
+            return
+
         # Сохраняем данные в БД, проверяя дубликаты
         if data_to_save:
-            async with async_session() as session:
-                for item in data_to_save:
-                    result = await session.execute(
-                        select(SpimexTradingResult).filter_by(
-                            exchange_product_id=item['exchange_product_id'],
-                            date=item['date']
-                        )
-                    )
-                    if not result.scalars().first():
-                        session.add(SpimexTradingResult(**item))
-                await session.commit()
-                print(f"Файл {filename} обработан, добавлено {len(data_to_save)} записей")
+            async with write_semaphore or nullcontext():
+                # дневная сводка пересчитывается в транзакции записи
+                if bulk:
+                    counts = await save_records(data_to_save, on_conflict=on_conflict)
+                else:
+                    counts = await _save_records_row_by_row(data_to_save)
+            print(f"Файл {filename} обработан, добавлено {counts['inserted']} записей, "
+                  f"обновлено {counts['updated']}, пропущено {counts['skipped']}")
+            return counts
+        return {'inserted': 0, 'updated': 0, 'skipped': 0}
 
     except Exception as e:
         print(f"Ошибка при обработке файла {filename}: {e}")
 
 
+async def _save_records_row_by_row(records):
+    """Построчная запись: SELECT на каждую строку, затем add (медленно, оставлено для сравнения)."""
+    await ensure_partitions({item['date'] for item in records})
+    inserted = 0
+    new_instruments = set()
+    async with async_session() as session:
+        if DB_NORMALIZED:
+            new_instruments = await _upsert_instruments(session, records)
+        for item in records:
+            result = await session.execute(
+                select(TRADING_TABLE.c.id).filter_by(
+                    exchange_product_id=item['exchange_product_id'],
+                    date=item['date']
+                )
+            )
+            if not result.first():
+                if DB_NORMALIZED:
+                    item = {k: v for k, v in item.items() if k not in INSTRUMENT_COLUMNS}
+                    session.add(SpimexTradingFact(**item))
+                else:
+                    session.add(SpimexTradingResult(**item))
+                inserted += 1
+        if inserted:
+            await session.flush()
+            await _refresh_daily_aggregates(session, sorted({item['date'] for item in records}))
+        await session.commit()
+    _known_instruments.update(new_instruments)
+    return {'inserted': inserted, 'updated': 0, 'skipped': len(records) - inserted}
+
+
 async def get_last_trading_date():
     """Получаем последнюю дату торгов"""
-    async with async_session() as session:
-        result = await session.execute(select(func.max(SpimexTradingResult.date)))
+    async with read_session() as session:
+        result = await session.execute(select(func.max(TRADING_TABLE.c.date)))
         return result.scalar()
 
 
+async def get_trading_dates(start_date: date = None, end_date: date = None):
+    """Множество дат, за которые в БД уже есть результаты торгов (опционально в пределах периода)"""
+    async with async_session() as session:
+        # только таблица фактов: в нормализованной схеме соединение со справочником здесь не нужно
+        query = select(TRADING_TABLE.c.date).distinct()
+        if start_date:
+            query = query.where(TRADING_TABLE.c.date >= start_date)
+        if end_date:
+            query = query.where(TRADING_TABLE.c.date <= end_date)
+        result = await session.execute(query)
+        return set(result.scalars().all())
+
+
+def keyset_condition(after: tuple, descending: bool) -> list:
+    """
+    Условия keyset-пагинации по (date, id): строки строго после курсора в порядке сортировки.
+    Отдельное условие на дату дублирует сравнение кортежей, чтобы planner использовал индексы
+    по дате (и отсекал партиции), — тогда глубокая страница стоит столько же, сколько первая.
+    """
+    after_date, after_id = after
+    key = tuple_(SpimexTradingResult.date, SpimexTradingResult.id)
+    if descending:
+        return [SpimexTradingResult.date <= after_date, key < tuple_(after_date, after_id)]
+    return [SpimexTradingResult.date >= after_date, key > tuple_(after_date, after_id)]
+
+
+def dynamics_query(start_date: date, end_date: date, oil_id: str = None,
+                   delivery_type_id: str = None, delivery_basis_id: str = None, limit: int = None,
+                   as_rows: bool = False, after: tuple = None):
+    """
+    Запрос для get_dynamics (отдельно, чтобы его можно было переиспользовать и проверить план).
+    as_rows=True — только колонки API_COLUMNS вместо ORM-сущностей.
+    after=(date, id) — последняя строка предыдущей страницы, см. keyset_condition.
+    """
+    conditions = [SpimexTradingResult.date.between(start_date, end_date)]
+    if oil_id:
+        conditions.append(SpimexTradingResult.oil_id == oil_id)
+    if delivery_type_id:
+        conditions.append(SpimexTradingResult.delivery_type_id == delivery_type_id)
+    if delivery_basis_id:
+        conditions.append(SpimexTradingResult.delivery_basis_id == delivery_basis_id)
+    if after:
+        conditions.extend(keyset_condition(after, descending=False))
+
+    query = (select(*API_COLUMNS) if as_rows else select(SpimexTradingResult))
+    query = query.where(and_(*conditions)).order_by(SpimexTradingResult.date.asc(), SpimexTradingResult.id.asc())
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
 async def get_dynamics(start_date: date, end_date: date, oil_id: str = None,
-                       delivery_type_id: str = None, delivery_basis_id: str = None, limit: int = None):
+                       delivery_type_id: str = None, delivery_basis_id: str = None, limit: int = None,
+                       as_rows: bool = False, after: tuple = None):
     """
     Получаем динамику за период с возможностью фильтрации по oil_id, delivery_type_id, delivery_basis_id.
     start_date и end_date обязателны — это основной смысл метода 'dynamics'.
+    as_rows=True — вернуть кортежи колонок API_COLUMNS вместо ORM-объектов (быстрее для больших выборок).
+    after=(date, id) — продолжить выдачу после этой строки (постранично по limit).
     """
-    async with async_session() as session:
-        conditions = [SpimexTradingResult.date.between(start_date, end_date)]
-        if oil_id:
-            conditions.append(SpimexTradingResult.oil_id == oil_id)
-        if delivery_type_id:
-            conditions.append(SpimexTradingResult.delivery_type_id == delivery_type_id)
-        if delivery_basis_id:
-            conditions.append(SpimexTradingResult.delivery_basis_id == delivery_basis_id)
-
-        query = select(SpimexTradingResult).where(and_(*conditions)).order_by(SpimexTradingResult.date.asc())
-        if limit:
-            query = query.limit(limit)
-
+    async with read_session() as session:
+        query = dynamics_query(start_date, end_date, oil_id=oil_id, delivery_type_id=delivery_type_id,
+                               delivery_basis_id=delivery_basis_id, limit=limit, as_rows=as_rows, after=after)
         result = await session.execute(query)
-        return result.scalars().all()
+        return result.all() if as_rows else result.scalars().all()
+
+
+# Сколько строк за раз забирать из серверного курсора при выгрузке
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 2000))
+
+
+async def stream_dynamics(start_date: date, end_date: date, oil_id: str = None,
+                          delivery_type_id: str = None, delivery_basis_id: str = None,
+                          batch_size: int = STREAM_BATCH_SIZE):
+    """
+    То же, что get_dynamics(as_rows=True), но без загрузки всей выборки в память:
+    строки читаются серверным курсором и отдаются пачками по batch_size (списки кортежей API_COLUMNS).
+    """
+    query = dynamics_query(start_date, end_date, oil_id=oil_id, delivery_type_id=delivery_type_id,
+                           delivery_basis_id=delivery_basis_id, as_rows=True)
+    async with read_session() as session:
+        result = await session.stream(query.execution_options(yield_per=batch_size))
+        async for rows in result.partitions(batch_size):
+            yield rows
+
+
+def trading_results_query(limit: int = 100, oil_id: str = None,
+                          delivery_type_id: str = None, delivery_basis_id: str = None, date_value: date = None,
+                          as_rows: bool = False, after: tuple = None):
+    """Запрос для get_trading_results (as_rows и after — как в dynamics_query, порядок обратный)"""
+    query = select(*API_COLUMNS) if as_rows else select(SpimexTradingResult)
+    if date_value:
+        query = query.where(SpimexTradingResult.date == date_value)
+    if oil_id:
+        query = query.where(SpimexTradingResult.oil_id == oil_id)
+    if delivery_type_id:
+        query = query.where(SpimexTradingResult.delivery_type_id == delivery_type_id)
+    if delivery_basis_id:
+        query = query.where(SpimexTradingResult.delivery_basis_id == delivery_basis_id)
+    if after:
+        query = query.where(*keyset_condition(after, descending=True))
+
+    return query.order_by(SpimexTradingResult.date.desc(), SpimexTradingResult.id.desc()).limit(limit)
 
 
 async def get_trading_results(limit: int = 100, oil_id: str = None,
-                              delivery_type_id: str = None, delivery_basis_id: str = None, date_value: date = None):
+                              delivery_type_id: str = None, delivery_basis_id: str = None, date_value: date = None,
+                              as_rows: bool = False, after: tuple = None):
     """
     Последние торговые результаты. Параметры фильтрации опциональны:
     - date_value — если указан, вернёт записи только за дату
     - иначе вернёт последние по дате записи (внутри limit)
+    - as_rows=True — кортежи колонок API_COLUMNS вместо ORM-объектов
+    - after=(date, id) — следующая страница после этой строки
     """
-    async with async_session() as session:
-        query = select(SpimexTradingResult)
-        if date_value:
-            query = query.where(SpimexTradingResult.date == date_value)
-        if oil_id:
-            query = query.where(SpimexTradingResult.oil_id == oil_id)
-        if delivery_type_id:
-            query = query.where(SpimexTradingResult.delivery_type_id == delivery_type_id)
-        if delivery_basis_id:
-            query = query.where(SpimexTradingResult.delivery_basis_id == delivery_basis_id)
-
-        query = query.order_by(SpimexTradingResult.date.desc()).limit(limit)
+    async with read_session() as session:
+        query = trading_results_query(limit=limit, oil_id=oil_id, delivery_type_id=delivery_type_id,
+                                      delivery_basis_id=delivery_basis_id, date_value=date_value, as_rows=as_rows,
+                                      after=after)
         result = await session.execute(query)
-        return result.scalars().all()
+        return result.all() if as_rows else result.scalars().all()
+
+
+async def get_daily_aggregates(start_date: date, end_date: date, oil_id: str = None,
+                               delivery_type_id: str = None, delivery_basis_id: str = None,
+                               group_by=('oil_id',)):
+    """
+    Дневные суммы из spimex_daily_aggregates за период: по дате и измерениям group_by
+    (подмножество AGGREGATE_DIMENSIONS). Возвращает строки с volume, total, count и vwap = total / volume.
+    """
+    unknown = set(group_by) - set(AGGREGATE_DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Unknown group_by dimensions: {sorted(unknown)}")
+    agg = SpimexDailyAggregate
+    dimensions = [getattr(agg, name) for name in AGGREGATE_DIMENSIONS if name in group_by]
+    volume = func.sum(agg.volume)
+    total = func.sum(agg.total)
+
+    conditions = [agg.date.between(start_date, end_date)]
+    if oil_id:
+        conditions.append(agg.oil_id == oil_id)
+    if delivery_type_id:
+        conditions.append(agg.delivery_type_id == delivery_type_id)
+    if delivery_basis_id:
+        conditions.append(agg.delivery_basis_id == delivery_basis_id)
+
+    query = (select(agg.date, *dimensions,
+                    volume.label('volume'), total.label('total'), func.sum(agg.count).label('count'),
+                    (total / func.nullif(volume, 0)).label('vwap'))
+             .where(and_(*conditions))
+             .group_by(agg.date, *dimensions)
+             .order_by(agg.date.asc(), *dimensions))
+    async with read_session() as session:
+        result = await session.execute(query)
+        return [dict(row) for row in result.mappings()]
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
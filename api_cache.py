@@ -0,0 +1,208 @@
+"""
+Кэш ответов API в Redis: пространство имён, версия формата и инвалидация по событиям загрузки.
+
+Ключи лежат под префиксом CACHE_NAMESPACE:vCACHE_VERSION:, поэтому кэш не мешает другим данным
+в той же БД Redis, а смена формата значений — это просто новая версия. Каждый ключ при записи
+регистрируется в индексе:
+  - ключи «последних данных» (last_results, last_dates, results без даты) — в множестве LATEST_INDEX;
+  - ключи за период [start, end] — в ZSET RANGE_INDEX со score = end.
+Загрузка публикует событие «изменились данные за даты D» (publish_data_changed): удаляются только
+ключи последних данных и периоды, пересекающие D, и увеличивается счётчик DATA_VERSION_KEY,
+по которому воркеры API сбрасывают свой локальный кэш. Значение, посчитанное до события, не
+сохраняется (store с data_version). Периоды целиком в прошлом живут CACHE_PAST_TTL, а индекс
+периодов ограничен CACHE_MAX_RANGE_KEYS: при переполнении вытесняются самые старые периоды.
+Значения от CACHE_COMPRESS_MIN_BYTES хранятся сжатыми (encode_value / decode_value).
+"""
+import os
+import time
+import zlib
+from bisect import bisect_left
+from datetime import date
+from typing import Iterable, Optional, Tuple
+
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
+
+# zstd опционален: без zstandard значения сжимаются zlib из стандартной библиотеки
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+
+CACHE_NAMESPACE = os.getenv("CACHE_NAMESPACE", "spimex")
+CACHE_VERSION = os.getenv("CACHE_VERSION", "1")
+# Страховочный срок для ключей, которые зависят от свежих данных (если событие загрузки потерялось)
+CACHE_TTL = int(os.getenv("CACHE_TTL", 24 * 60 * 60))
+# Срок для периодов целиком в прошлом: они сбрасываются только загрузкой, срок лишь ограничивает
+# рост числа ключей от редких фильтров
+CACHE_PAST_TTL = int(os.getenv("CACHE_PAST_TTL", 30 * 24 * 60 * 60))
+# Сколько периодов держать в RANGE_INDEX; лишние (с самым ранним концом) удаляются вместе с ключами
+CACHE_MAX_RANGE_KEYS = int(os.getenv("CACHE_MAX_RANGE_KEYS", 50000))
+
+PREFIX = f"{CACHE_NAMESPACE}:v{CACHE_VERSION}:"
+LATEST_INDEX = PREFIX + "idx:latest"
+RANGE_INDEX = PREFIX + "idx:ranges"
+DATA_VERSION_KEY = f"{CACHE_NAMESPACE}:data_version"
+# Время (unix) последнего изменения данных — для заголовка Last-Modified
+DATA_CHANGED_AT_KEY = f"{CACHE_NAMESPACE}:data_changed_at"
+DATA_CHANGED_CHANNEL = f"{CACHE_NAMESPACE}:data_changed"
+# ZSET «путь запроса с параметрами -> число обращений», по нему выбирается, что прогревать
+ACCESS_STATS_KEY = f"{CACHE_NAMESPACE}:stats:requests"
+# Сколько записей хранить в статистике и во сколько раз ослаблять счётчики после каждой загрузки
+# (старые популярные периоды постепенно уступают место новым)
+ACCESS_STATS_MAX = int(os.getenv("ACCESS_STATS_MAX", 1000))
+ACCESS_STATS_DECAY = float(os.getenv("ACCESS_STATS_DECAY", 0.5))
+
+# Сжатие значений в Redis: кодек (zstd, zlib или none) и размер, начиная с которого значение сжимается
+CACHE_CODEC = os.getenv("CACHE_CODEC", "zstd" if zstandard else "zlib")
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", 4096))
+CACHE_COMPRESS_LEVEL = int(os.getenv("CACHE_COMPRESS_LEVEL", 3))
+if CACHE_CODEC == "zstd" and zstandard is None:
+    print("CACHE_CODEC=zstd, но пакет zstandard не установлен — используется zlib")
+    CACHE_CODEC = "zlib"
+
+# Сжатое значение начинается с \x01 и байта кодека. Несжатые тела (JSON, Arrow, Parquet,
+# страница с курсором через \0) так не начинаются, поэтому старые записи читаются как есть.
+_COMPRESSED = b"\x01"
+_CODEC_IDS = {"zstd": b"z", "zlib": b"d"}
+
+# Период [start, end] ответа; None — ответ зависит от последних данных
+Scope = Optional[Tuple[date, date]]
+
+
+def redis_key(key: str) -> str:
+    return PREFIX + key
+
+
+def cache_ttl(scope: Scope) -> int:
+    """TTL ключа в Redis: CACHE_PAST_TTL для периода, который целиком в прошлом, иначе CACHE_TTL"""
+    if scope is not None and scope[1] < date.today():
+        return CACHE_PAST_TTL
+    return CACHE_TTL
+
+
+async def read_data_version(redis) -> bytes:
+    """Текущая версия данных (b"0", пока загрузок не было)"""
+    return await redis.get(DATA_VERSION_KEY) or b"0"
+
+
+def encode_value(body: bytes) -> bytes:
+    """Значение для Redis: тело ответа, сжатое CACHE_CODEC, если оно не меньше порога"""
+    if CACHE_CODEC not in _CODEC_IDS or len(body) < CACHE_COMPRESS_MIN_BYTES:
+        return body
+    if CACHE_CODEC == "zstd":
+        packed = zstandard.ZstdCompressor(level=CACHE_COMPRESS_LEVEL).compress(body)
+    else:
+        packed = zlib.compress(body, CACHE_COMPRESS_LEVEL)
+    return _COMPRESSED + _CODEC_IDS[CACHE_CODEC] + packed
+
+
+def decode_value(raw: bytes) -> bytes:
+    """Обратное к encode_value; несжатые (в том числе старые) значения возвращаются без изменений"""
+    if raw[:1] != _COMPRESSED:
+        return raw
+    codec, packed = raw[1:2], raw[2:]
+    if codec == _CODEC_IDS["zstd"]:
+        return zstandard.ZstdDecompressor().decompress(packed)
+    return zlib.decompress(packed)
+
+
+async def store(redis, key: str, body: bytes, scope: Scope = None, data_version: Optional[bytes] = None) -> bool:
+    """
+    Значение (см. encode_value) и его запись в индексе — одной транзакцией. data_version —
+    версия данных (read_data_version), с которой значение начали считать: если с тех пор прошла
+    загрузка, значение устарело и не сохраняется. Возвращает, сохранено ли значение.
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        try:
+            if data_version is not None:
+                # WATCH: событие загрузки между проверкой и записью отменит транзакцию
+                await pipe.watch(DATA_VERSION_KEY)
+                if await read_data_version(pipe) != data_version:
+                    return False
+                pipe.multi()
+            pipe.set(redis_key(key), encode_value(body), ex=cache_ttl(scope))
+            if scope is None:
+                pipe.sadd(LATEST_INDEX, key)
+            else:
+                start, end = scope
+                pipe.zadd(RANGE_INDEX, {f"{start.toordinal()}|{key}": end.toordinal()})
+                pipe.zcard(RANGE_INDEX)
+            results = await pipe.execute()
+        except WatchError:
+            return False
+    if scope is not None and results[-1] > CACHE_MAX_RANGE_KEYS:
+        await evict_ranges(redis, results[-1] - CACHE_MAX_RANGE_KEYS)
+    return True
+
+
+async def evict_ranges(redis, count: int) -> None:
+    """Удаляет count периодов с самым ранним концом вместе с их ключами"""
+    members = await redis.zpopmin(RANGE_INDEX, count)
+    if members:
+        await redis.delete(*(redis_key(m.split(b"|", 1)[1].decode()) for m, _ in members))
+
+
+async def invalidate_dates(redis, dates: Iterable[date]) -> int:
+    """Удаляет ключи последних данных и периоды, пересекающие dates. Возвращает число ключей."""
+    days = sorted({d.toordinal() for d in dates})
+    if not days:
+        return 0
+    # Сначала новая версия, потом чтение индексов: store() с версией до загрузки либо успел
+    # выполниться раньше (и его ключ попадёт в удаляемые), либо его WATCH увидит новую версию
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.incr(DATA_VERSION_KEY)
+        pipe.set(DATA_CHANGED_AT_KEY, int(time.time()))
+        await pipe.execute()
+
+    latest = await redis.smembers(LATEST_INDEX)
+    # кандидаты — периоды, которые заканчиваются не раньше первой даты
+    ranges = await redis.zrangebyscore(RANGE_INDEX, days[0], "+inf", withscores=True)
+    stale = []
+    for member, end in ranges:
+        start = int(member.split(b"|", 1)[0])
+        i = bisect_left(days, start)
+        if i < len(days) and days[i] <= end:
+            stale.append(member)
+
+    keys = [redis_key(k.decode()) for k in latest] + [redis_key(m.split(b"|", 1)[1].decode()) for m in stale]
+    async with redis.pipeline(transaction=False) as pipe:
+        if keys:
+            pipe.delete(*keys)
+        if latest:
+            pipe.srem(LATEST_INDEX, *latest)
+        if stale:
+            pipe.zrem(RANGE_INDEX, *stale)
+        pipe.publish(DATA_CHANGED_CHANNEL, ",".join(date.fromordinal(d).isoformat() for d in days))
+        await pipe.execute()
+    return len(keys)
+
+
+async def publish_data_changed(dates: Iterable[date], redis=None) -> Optional[int]:
+    """
+    Событие загрузки: данные за dates изменились. Без клиента открывает своё соединение.
+    Недоступный Redis не должен ронять загрузку — ошибка только печатается.
+    """
+    client = redis or aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    try:
+        removed = await invalidate_dates(client, dates)
+        print(f"Кэш API: сброшено ключей {removed}")
+        return removed
+    except Exception as e:
+        print(f"Ошибка инвалидации кэша: {e}")
+        return None
+    finally:
+        if redis is None:
+            await client.aclose()
+
+
+async def decay_access_stats(redis, factor: float = ACCESS_STATS_DECAY) -> None:
+    """Умножает счётчики статистики запросов на factor и удаляет записи, упавшие ниже одного запроса"""
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zunionstore(ACCESS_STATS_KEY, {ACCESS_STATS_KEY: factor})
+        pipe.zremrangebyscore(ACCESS_STATS_KEY, "-inf", "(1")
+        await pipe.execute()
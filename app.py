@@ -1,69 +1,232 @@
-import json
+import asyncio
+import base64
+import binascii
+import csv
+import gzip
+import hashlib
+import io
+import os
+import secrets
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
 from decimal import Decimal
-from datetime import date, datetime, time, timedelta
-from typing import Optional, List, Dict, Any
-from fastapi import FastAPI, HTTPException, Query, Depends
+from datetime import date
+from email.utils import formatdate
+from time import monotonic
+from urllib.parse import parse_qsl, urlencode
+from typing import Optional, List, Dict, Any, Literal, Callable, Awaitable
+import orjson
+from fastapi import FastAPI, HTTPException, Query, Depends, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import Headers
 from pydantic import BaseModel, Field
 from sqlalchemy.exc import SQLAlchemyError
-from redis import Redis
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
 from sqlalchemy import select
 
-from DB_interface import SpimexTradingResult, async_session, get_dynamics, get_last_trading_date, get_trading_results
+# Колоночные форматы (Arrow IPC / Parquet) опциональны: без pyarrow API отдаёт только JSON
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
-app = FastAPI(title="Spimex trading API",
-              description="API для выдачи данных из таблицы spimex_trading_results. Кэш сохраняется до 14:11, " 
-                          "после этого происходит инвалидация кэша.",
-              version="1.0")
+# Brotli опционален: без пакета brotli ответы сжимаются gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+from api_cache import (ACCESS_STATS_KEY, ACCESS_STATS_MAX, CACHE_TTL, CACHE_VERSION, DATA_CHANGED_AT_KEY,
+                       DATA_VERSION_KEY, REDIS_DB, REDIS_HOST, REDIS_PORT, Scope, decode_value, read_data_version,
+                       redis_key, store)
+from DB_interface import (TRADING_TABLE, get_daily_aggregates, get_dynamics, read_session,
+                          get_last_trading_date, get_trading_results, stream_dynamics)
 
 # ---------- Redis init ----------
-try:
-    redis = Redis(host='localhost', port=6379, db=0, decode_responses=False)
-    redis.ping()
-except Exception as e:
-    print(f"Redis connection error: {e}")
-    redis = None
-
-
-def seconds_until_next_invalidation() -> int:
-    now = datetime.now()
-    today_target = now.replace(hour=14,
-                               minute=11,
-                               second=0,
-                               microsecond=0)
-    if now < today_target:
-        delta = today_target - now
-    else:
-        tomorrow_target = today_target + timedelta(days=1)
-        delta = tomorrow_target - now
-    return int(delta.total_seconds())
+# Размер пула соединений и сколько ждать свободное соединение, когда пул занят
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
 
+# Асинхронный клиент (redis.asyncio — преемник aioredis), подключается при старте приложения
+redis: Optional[aioredis.Redis] = None
 
-def invalidate_cache_if_needed():
-    """Сбросит Redis один раз после пересечения порога 14:11 (сохраняет метку даты)."""
-    if not redis:
+
+async def connect_redis():
+    global redis
+    pool = aioredis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+                                           max_connections=REDIS_MAX_CONNECTIONS,
+                                           timeout=REDIS_POOL_TIMEOUT,
+                                           decode_responses=False)
+    client = aioredis.Redis(connection_pool=pool)
+    try:
+        await client.ping()
+        redis = client
+    except Exception as e:
+        print(f"Redis connection error: {e}")
+        await client.aclose()
+        redis = None
+
+
+async def close_redis():
+    global redis
+    if redis:
+        await redis.aclose()
+        redis = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await connect_redis()
+    yield
+    await close_redis()
+
+
+app = FastAPI(title="Spimex trading API",
+              description="API для выдачи данных из таблицы spimex_trading_results. Кэш сбрасывается "
+                          "по событиям загрузки новых данных.",
+              version="1.0",
+              lifespan=lifespan)
+
+
+# Как часто воркер сверяет счётчик версии данных в Redis (после загрузки локальный кэш сбрасывается)
+CACHE_EVENT_POLL = float(os.getenv("CACHE_EVENT_POLL", 1))
+data_version: Optional[bytes] = None
+data_changed_at: Optional[int] = None
+_version_checked_at = float("-inf")
+
+
+async def sync_local_cache():
+    """
+    Сбрасывает локальный кэш, если загрузка опубликовала изменение данных (см. api_cache).
+    Ключи в Redis загрузка удаляет сама, здесь догоняются только копии в памяти процесса.
+    Заодно отправляет в Redis накопленную статистику запросов (по ней прогревается кэш).
+    """
+    global data_version, data_changed_at, _version_checked_at
+    if not redis or monotonic() - _version_checked_at < CACHE_EVENT_POLL:
         return
+    _version_checked_at = monotonic()
     try:
-        now = datetime.now()
-        today_str = now.date().isoformat()
-        target_time = now.replace(hour=14,
-                                  minute=11,
-                                  second=0,
-                                  microsecond=0)
-        last = redis.get("last_invalidation_date")
-        last = last.decode() if last else None
-
-        # Если сейчас уже после целевого времени и сброс ещё не делался сегодня -> flush
-        if now >= target_time and last != today_str:
-            # flush only cache DB (be careful on prod; лучше ключи с префиксом). Здесь мы предполагаем отдельную БД Redis.
-            try:
-                redis.flushdb()
-                redis.set("last_invalidation_date", today_str)
-                print("Redis cache flushed due to daily invalidation.")
-            except Exception as e:
-                print("Failed to flush redis:", e)
+        version, changed_at = await redis.mget(DATA_VERSION_KEY, DATA_CHANGED_AT_KEY)
+        await flush_access_stats()
     except Exception as e:
-        print("invalidate_cache_if_needed error:", e)
+        print(f"Cache version error: {e}")
+        return
+    # до первой загрузки счётчика нет — это тоже версия
+    version = version or b"0"
+    if version != data_version:
+        local_cache.clear()
+        data_version = version
+    data_changed_at = int(changed_at) if changed_at else None
+
+
+# Успешные запросы к кэшируемым эндпоинтам (путь с параметрами -> число), копятся в процессе
+# и раз в CACHE_EVENT_POLL уходят в Redis, чтобы не писать в него на каждый запрос
+access_stats: Counter = Counter()
+# Запросы прогрева помечаются заголовком и в статистику не попадают
+WARMUP_HEADER = "X-Cache-Warmup"
+# Параметры, которые входят в запись статистики (остальные API не влияют на ответ и отбрасываются)
+ACCESS_STATS_PARAMS = frozenset({"start_date", "end_date", "date_value", "oil_id", "delivery_type_id",
+                                 "delivery_basis_id", "group_by", "limit", "format"})
+
+
+def access_entry(path: str, query_string: bytes) -> Optional[str]:
+    """
+    Запись статистики для запроса: путь и известные параметры в постоянном порядке,
+    так что одинаковые по смыслу запросы считаются вместе. None — запрос не учитывается (страница по курсору).
+    """
+    params = parse_qsl(query_string.decode("latin-1"))
+    if any(name == "cursor" for name, _ in params):
+        return None
+    params = sorted((name, value) for name, value in params if name in ACCESS_STATS_PARAMS)
+    return f"{path}?{urlencode(params)}" if params else path
+
+
+def record_access(path: str, query_string: bytes, headers: Headers) -> None:
+    if not redis or headers.get(WARMUP_HEADER):
+        return
+    entry = access_entry(path, query_string)
+    if entry:
+        access_stats[entry] += 1
+
+
+async def flush_access_stats() -> None:
+    if not access_stats:
+        return
+    counts = dict(access_stats)
+    access_stats.clear()
+    async with redis.pipeline(transaction=False) as pipe:
+        for path, count in counts.items():
+            pipe.zincrby(ACCESS_STATS_KEY, count, path)
+        # держим только ACCESS_STATS_MAX самых частых записей
+        pipe.zremrangebyrank(ACCESS_STATS_KEY, 0, -ACCESS_STATS_MAX - 1)
+        await pipe.execute()
+
+
+# ---------- HTTP-кэширование ----------
+# Ответы этих эндпоинтов меняются только вместе с версией данных, поэтому ETag строится
+# из версии и самого запроса, а If-None-Match проверяется до Redis и Postgres
+HTTP_CACHE_PATHS = {"/last_results", "/last_dates", "/results", "/dynamics", "/dynamics/daily"}
+HTTP_MAX_AGE = int(os.getenv("HTTP_MAX_AGE", 60))
+
+
+def make_etag(path: str, query: bytes, accept: str, accept_encoding: str = "") -> str:
+    """
+    Сильный ETag: версия данных + версия формата кэша + хэш запроса
+    (Accept и Accept-Encoding влияют на формат и сжатие ответа)
+    """
+    negotiated = f"{accept}|{accept_encoding}".encode()
+    digest = hashlib.blake2b(b"%s?%s|%s" % (path.encode(), query, negotiated), digest_size=8).hexdigest()
+    return f'"{data_version.decode()}.{CACHE_VERSION}.{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+class HTTPCacheMiddleware:
+    """
+    ASGI-middleware для GET к HTTP_CACHE_PATHS: ETag / Last-Modified / Cache-Control на ответах 200
+    и 304 на совпавший If-None-Match без вызова эндпоинта. Версия данных сверяется с Redis
+    не чаще CACHE_EVENT_POLL; пока она неизвестна (нет Redis), заголовки не выставляются.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or scope["path"] not in HTTP_CACHE_PATHS:
+            return await self.app(scope, receive, send)
+        await sync_local_cache()
+        if data_version is None:
+            return await self.app(scope, receive, send)
+
+        request_headers = Headers(scope=scope)
+        etag = make_etag(scope["path"], scope["query_string"], request_headers.get("accept", ""),
+                         request_headers.get("accept-encoding", ""))
+        cache_headers = {"ETag": etag, "Cache-Control": f"public, max-age={HTTP_MAX_AGE}", "Vary": "Accept"}
+        if data_changed_at:
+            cache_headers["Last-Modified"] = formatdate(data_changed_at, usegmt=True)
+
+        if etag_matches(request_headers.get("if-none-match"), etag):
+            return await Response(status_code=304, headers=cache_headers)(scope, receive, send)
+
+        encoded = [(name.lower().encode(), value.encode()) for name, value in cache_headers.items()]
+
+        async def send_with_cache_headers(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                message["headers"] = list(message.get("headers", [])) + encoded
+                # в статистику (для прогрева) попадают только запросы, прошедшие валидацию
+                record_access(scope["path"], scope["query_string"], request_headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_cache_headers)
+
+
+app.add_middleware(HTTPCacheMiddleware)
 
 
 class TradingResult(BaseModel):
@@ -83,86 +246,463 @@ class TradingResult(BaseModel):
         orm_mode = True
 
 
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        if isinstance(obj, (date, datetime)):
-            return obj.isoformat()
-        return super().default(obj)
+class DailyAggregate(BaseModel):
+    date: date
+    oil_id: Optional[str] = None
+    delivery_basis_id: Optional[str] = None
+    delivery_type_id: Optional[str] = None
+    volume: float
+    total: float
+    count: int
+    vwap: Optional[float] = None
+
+
+# Поля, которые отдаёт API (created_on / updated_on в ответ не попадают)
+TRADING_RESULT_FIELDS = tuple(TradingResult.model_fields)
+DAILY_AGGREGATE_FIELDS = tuple(DailyAggregate.model_fields)
+
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
-def get_cache(key: str) -> Optional[Any]:
+def json_bytes(value: Any) -> bytes:
+    """Тело ответа в JSON через orjson (date/datetime — нативно в ISO, Decimal -> float)."""
+    return orjson.dumps(value, default=_json_default)
+
+
+# ---------- Сжатие ответов ----------
+# Большие тела сжимаются один раз при сборке и в таком виде лежат в кэше: попадание отдаётся
+# клиенту как есть с Content-Encoding, а клиенту без поддержки сжатия — распакованным
+HTTP_COMPRESSION = os.getenv("HTTP_COMPRESSION", "br" if brotli else "gzip")
+if HTTP_COMPRESSION == "br" and brotli is None:
+    print("HTTP_COMPRESSION=br, но пакет brotli не установлен — используется gzip")
+    HTTP_COMPRESSION = "gzip"
+HTTP_COMPRESS_MIN_BYTES = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", 1024))
+HTTP_COMPRESS_LEVEL = int(os.getenv("HTTP_COMPRESS_LEVEL", 5))
+# Сжатое тело начинается с \x02 и байта кодировки (JSON, Arrow и Parquet так не начинаются)
+_COMPRESSED_BODY = b"\x02"
+_ENCODING_IDS = {"gzip": b"g", "br": b"b"}
+_ENCODINGS = {v: k for k, v in _ENCODING_IDS.items()}
+
+
+def compress_body(body: bytes) -> bytes:
+    """Тело для кэша: сжатое HTTP_COMPRESSION, если оно не меньше HTTP_COMPRESS_MIN_BYTES"""
+    if HTTP_COMPRESSION not in _ENCODING_IDS or len(body) < HTTP_COMPRESS_MIN_BYTES:
+        return body
+    if HTTP_COMPRESSION == "br":
+        packed = brotli.compress(body, quality=HTTP_COMPRESS_LEVEL)
+    else:
+        packed = gzip.compress(body, compresslevel=HTTP_COMPRESS_LEVEL, mtime=0)
+    return _COMPRESSED_BODY + _ENCODING_IDS[HTTP_COMPRESSION] + packed
+
+
+def accepted_encodings(request: Request) -> frozenset:
+    """Зависимость: кодировки из Accept-Encoding (без отключённых через q=0)"""
+    encodings = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            encodings.add(name.lower())
+    return frozenset(encodings)
+
+
+def encode_for_client(body: bytes, encodings: frozenset) -> tuple:
+    """(тело, заголовки): сжатое тело уходит как есть, если клиент принимает его кодировку"""
+    if body[:1] != _COMPRESSED_BODY:
+        return body, {}
+    encoding, payload = _ENCODINGS[body[1:2]], body[2:]
+    if encoding in encodings or "*" in encodings:
+        return payload, {"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+    if encoding == "br":
+        return brotli.decompress(payload), {"Vary": "Accept-Encoding"}
+    return gzip.decompress(payload), {"Vary": "Accept-Encoding"}
+
+
+def json_response(body: bytes, next_cursor: Optional[str] = None, encodings: frozenset = frozenset(),
+                  media_type: str = "application/json") -> Response:
+    """
+    Готовое JSON-тело без валидации response_model и повторной сериализации:
+    так отдаются и попадания в кэш, и только что собранные ответы.
+    next_cursor — токен следующей страницы, уходит в заголовке NEXT_CURSOR_HEADER.
+    encodings — что принимает клиент (см. compress_body / encode_for_client).
+    """
+    body, headers = encode_for_client(body, encodings)
+    if next_cursor:
+        headers[NEXT_CURSOR_HEADER] = next_cursor
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+# ---------- Keyset-пагинация ----------
+# Курсор — непрозрачный токен из (date, id) последней строки страницы; клиент передаёт его в ?cursor=
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+_DATE_INDEX = TRADING_RESULT_FIELDS.index("date")
+_ID_INDEX = TRADING_RESULT_FIELDS.index("id")
+
+
+def encode_cursor(day: date, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{day.isoformat()}:{row_id}".encode()).decode()
+
+
+def decode_cursor(token: Optional[str]) -> Optional[tuple]:
+    """Токен -> (date, id); битый токен — 400, а не 500"""
+    if not token:
+        return None
+    try:
+        day, row_id = base64.urlsafe_b64decode(token.encode()).decode().split(":")
+        return date.fromisoformat(day), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+
+def next_cursor(rows, limit: Optional[int]) -> Optional[str]:
+    """Курсор следующей страницы, если страница заполнена целиком (иначе данных дальше нет)"""
+    if not limit or len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor(last[_DATE_INDEX], last[_ID_INDEX])
+
+
+def pack_page(body: bytes, cursor: Optional[str]) -> bytes:
+    """
+    Запись кэша для страницы: курсор хранится перед телом через \\0, чтобы попадание в кэш
+    отдавало и заголовок без второго запроса. Страница без курсора хранится как обычное тело.
+    """
+    return b"\0" + cursor.encode() + b"\0" + body if cursor else body
+
+
+def unpack_page(cached: bytes) -> tuple:
+    """Обратное к pack_page: (тело, курсор или None)"""
+    if cached[:1] == b"\0":
+        _, cursor, body = cached.split(b"\0", 2)
+        return body, cursor.decode()
+    return cached, None
+
+
+class LocalCache:
+    """
+    In-process LRU-кэш сериализованных ответов перед Redis.
+    Объём ограничен суммарным размером значений в байтах, у каждой записи свой срок жизни.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key: str) -> Optional[bytes]:
+        item = self._items.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, value = item
+        if expires_at <= monotonic():
+            self._remove(key)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._items.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        if key in self._items:
+            self._remove(key)
+        # значение больше всего кэша не храним, иначе оно вытеснит всё остальное
+        if ttl <= 0 or len(value) > self.max_bytes:
+            return
+        self._items[key] = (monotonic() + ttl, value)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._items))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        self._items.clear()
+        self.size = 0
+
+    def _remove(self, key: str) -> None:
+        _, value = self._items.pop(key)
+        self.size -= len(value)
+
+    def info(self) -> Dict[str, Any]:
+        return {**self.stats, "keys": len(self._items), "bytes": self.size, "max_bytes": self.max_bytes}
+
+
+# Локальная копия ответа живёт CACHE_TTL и сбрасывается целиком при смене версии данных (sync_local_cache)
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+local_cache = LocalCache(LOCAL_CACHE_MAX_BYTES)
+
+
+async def get_cache(key: str) -> Optional[bytes]:
+    """Готовое JSON-тело ответа из локального кэша или Redis (без декодирования)."""
+    raw = local_cache.get(key)
+    if raw is not None:
+        return raw
     if not redis:
         return None
     try:
-        raw = redis.get(key)
+        raw = await redis.get(redis_key(key))
         if not raw:
             return None
         # redis stored json bytes
-        if isinstance(raw, bytes):
-            raw = raw.decode()
-        return json.loads(raw)
+        if isinstance(raw, str):
+            raw = raw.encode()
+        # в Redis большие значения лежат сжатыми, в локальном кэше — готовым телом
+        raw = decode_value(raw)
+        local_cache.set(key, raw, CACHE_TTL)
+        return raw
     except Exception as e:
         print(f"Cache get error: {e}")
         return None
 
 
-def set_cache(key: str, value: Any) -> None:
-    """Сохраняем в Redis с TTL до следующей инвалидации (до next 14:11)."""
+async def set_cache(key: str, body: bytes, scope: Scope = None, data_version: Optional[bytes] = None) -> None:
+    """
+    Сохраняем JSON-тело в локальный кэш и в Redis. scope=(start, end) — период данных ответа,
+    по нему ключ сбрасывается при загрузке; None — ответ по последним данным.
+    data_version — версия данных на момент начала расчёта: если с тех пор прошла загрузка,
+    тело устарело и не сохраняется ни в Redis, ни локально.
+    """
+    stored = True
+    if redis:
+        try:
+            stored = await store(redis, key, body, scope, data_version)
+        except Exception as e:
+            print(f"Cache set error: {e}")
+    if stored:
+        local_cache.set(key, body, CACHE_TTL)
+
+
+async def current_data_version() -> Optional[bytes]:
+    """Версия данных из Redis для set_cache; None — без Redis (или при его ошибке) не проверяем"""
     if not redis:
+        return None
+    try:
+        return await read_data_version(redis)
+    except Exception as e:
+        print(f"Cache get error: {e}")
+        return None
+
+
+# ---------- Single-flight ----------
+# Одинаковые промахи кэша в процессе ждут одну задачу, между воркерами — короткую блокировку в Redis
+SINGLE_FLIGHT_LOCK_MS = int(os.getenv("SINGLE_FLIGHT_LOCK_MS", 10000))
+SINGLE_FLIGHT_WAIT = float(os.getenv("SINGLE_FLIGHT_WAIT", 10))
+SINGLE_FLIGHT_POLL = float(os.getenv("SINGLE_FLIGHT_POLL", 0.05))
+_inflight: Dict[str, asyncio.Task] = {}
+
+
+def _lock_key(key: str) -> str:
+    return redis_key(f"lock:{key}")
+
+
+async def _acquire_fill_lock(key: str) -> Optional[str]:
+    """
+    Блокировка на вычисление ключа между воркерами. Возвращает токен владельца или None,
+    если ключ уже считает другой воркер. Без Redis (или при его ошибке) считаем сами — пустой токен.
+    """
+    if not redis:
+        return ""
+    token = secrets.token_hex(8)
+    try:
+        acquired = await redis.set(_lock_key(key), token, nx=True, px=SINGLE_FLIGHT_LOCK_MS)
+    except Exception as e:
+        print(f"Cache lock error: {e}")
+        return ""
+    return token if acquired else None
+
+
+async def _release_fill_lock(key: str, token: str) -> None:
+    """Снимает блокировку, только если она всё ещё наша (истёкшую мог взять другой воркер)"""
+    if not redis or not token:
         return
     try:
-        ttl = seconds_until_next_invalidation()
-        json_value = json.dumps(value, cls=CustomJSONEncoder)
-        redis.setex(key, ttl, json_value)
+        async with redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(_lock_key(key))
+            if await pipe.get(_lock_key(key)) == token.encode():
+                pipe.multi()
+                pipe.delete(_lock_key(key))
+                await pipe.execute()
+    except WatchError:
+        # блокировка сменила владельца между GET и DELETE — она уже не наша
+        pass
     except Exception as e:
-        print(f"Cache set error: {e}")
+        print(f"Cache lock error: {e}")
 
 
-def model_to_serializable(m) -> Dict[str, Any]:
-    """Преобразуем объект SQLAlchemy в serializable dict (Decimal->float, date->iso)."""
-    out = {}
-    for col in m.__table__.columns:
-        val = getattr(m, col.name)
-        if isinstance(val, Decimal):
-            out[col.name] = float(val)
-        elif isinstance(val, (date, datetime)):
-            out[col.name] = val.isoformat()
-        else:
-            out[col.name] = val
-    return out
+async def _lock_released(key: str) -> bool:
+    try:
+        return not await redis.exists(_lock_key(key))
+    except Exception as e:
+        print(f"Cache lock error: {e}")
+        return False
 
 
-def cache_invalidation_dep():
-    invalidate_cache_if_needed()
+async def _fill_cache(key: str, load: Callable[[], Awaitable[bytes]], scope: Scope = None) -> bytes:
+    """
+    Вычисляет значение ключа и кладёт его в кэш. Если ключ уже считает другой воркер,
+    ждёт его результат в кэше; если тот снял блокировку, ничего не сохранив (ошибка load),
+    забираем блокировку себе. Не дождались за SINGLE_FLIGHT_WAIT — считаем сами.
+    """
+    token = await _acquire_fill_lock(key)
+    if token is None:
+        deadline = monotonic() + SINGLE_FLIGHT_WAIT
+        while monotonic() < deadline:
+            await asyncio.sleep(SINGLE_FLIGHT_POLL)
+            cached = await get_cache(key)
+            if cached is not None:
+                return cached
+            if await _lock_released(key):
+                token = await _acquire_fill_lock(key)
+                if token is not None:
+                    # владелец мог сохранить значение и снять блокировку между двумя проверками выше
+                    cached = await get_cache(key)
+                    if cached is not None:
+                        await _release_fill_lock(key, token)
+                        return cached
+                    break
+    try:
+        # версию запоминаем до чтения из БД: загрузка во время load() сделает результат устаревшим
+        version = await current_data_version()
+        body = await load()
+        await set_cache(key, body, scope, data_version=version)
+        return body
+    finally:
+        if token:
+            await _release_fill_lock(key, token)
+
+
+async def single_flight(key: str, load: Callable[[], Awaitable[bytes]], scope: Scope = None) -> bytes:
+    """
+    Значение для промаха кэша по ключу key: первый запрос запускает load(), одновременные
+    такие же запросы ждут ту же задачу. Задача не отменяется вместе с запросом, который её начал.
+    scope передаётся в set_cache.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fill_cache(key, load, scope))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+def trading_rows_body(rows) -> bytes:
+    """
+    JSON-тело списка TradingResult из кортежей колонок (get_* с as_rows=True).
+    Порядок колонок совпадает с TRADING_RESULT_FIELDS, числа уже float, даты orjson пишет сам.
+    """
+    fields = TRADING_RESULT_FIELDS
+    return json_bytes([dict(zip(fields, row)) for row in rows])
+
+
+# ---------- Колоночные форматы ----------
+FORMAT_MEDIA_TYPES = {
+    "json": "application/json",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+ARROW_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("exchange_product_id", pa.string()),
+    ("exchange_product_name", pa.string()),
+    ("oil_id", pa.string()),
+    ("delivery_basis_id", pa.string()),
+    ("delivery_basis_name", pa.string()),
+    ("delivery_type_id", pa.string()),
+    ("volume", pa.float64()),
+    ("total", pa.float64()),
+    ("count", pa.int64()),
+    ("date", pa.date32()),
+]) if pa else None
+
+
+def response_format(request: Request,
+                    format: Optional[Literal["json", "arrow", "parquet"]] = Query(
+                        None, description="Формат ответа; без параметра выбирается по Accept, по умолчанию json")
+                    ) -> str:
+    """Зависимость: формат ответа из ?format= или заголовка Accept"""
+    if format is None:
+        accept = request.headers.get("accept", "")
+        format = next((fmt for fmt, media_type in FORMAT_MEDIA_TYPES.items()
+                       if fmt != "json" and media_type in accept), "json")
+    if format != "json" and pa is None:
+        raise HTTPException(status_code=406, detail=f"format {format} requires pyarrow")
+    return format
+
+
+def arrow_table(rows):
+    """Таблица Arrow из кортежей колонок: колонки собираются целиком, без словарей на строку"""
+    columns = list(zip(*rows)) or [()] * len(ARROW_SCHEMA)
+    return pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, ARROW_SCHEMA)],
+                                schema=ARROW_SCHEMA)
+
+
+def rows_body(rows, fmt: str) -> bytes:
+    """Тело ответа со строками TradingResult в нужном формате"""
+    if fmt == "json":
+        return trading_rows_body(rows)
+    sink = pa.BufferOutputStream()
+    table = arrow_table(rows)
+    if fmt == "parquet":
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_stream(sink, ARROW_SCHEMA) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def rows_response(body: bytes, fmt: str, next_cursor: Optional[str] = None,
+                  encodings: frozenset = frozenset()) -> Response:
+    """Как json_response, но с типом содержимого выбранного формата"""
+    return json_response(body, next_cursor, encodings, media_type=FORMAT_MEDIA_TYPES[fmt])
+
+
+def format_key(cache_key: str, fmt: str) -> str:
+    """JSON-ключи кэша не меняются, остальные форматы кэшируются рядом с суффиксом"""
+    return cache_key if fmt == "json" else f"{cache_key}:{fmt}"
+
+
+async def cache_invalidation_dep(request: Request):
+    await sync_local_cache()
 
 # ---------- Endpoints ----------
+@app.get("/cache/stats", summary="Статистика локального кэша")
+async def get_cache_stats():
+    """Попадания, промахи, вытеснения и занятый объём in-process кэша этого процесса."""
+    return local_cache.info()
+
+
 @app.get("/last_dates", response_model=List[date], summary="Последние даты торгов")
-async def get_last_trading_dates(limit: int = Query(10, ge=1, le=365, description="Количество последних дат")):
+async def get_last_trading_dates(limit: int = Query(10, ge=1, le=365, description="Количество последних дат"),
+                                 encodings: frozenset = Depends(accepted_encodings),
+                                 _ = Depends(cache_invalidation_dep)):
     """
     Возвращает список уникальных последних дат торгов (по убыванию).
     Параметр:
       - limit (опционально, default=10) — сколько последних дат вернуть.
     """
     cache_key = f"last_dates:{limit}"
-    # проверяем кэш (и запускаем инвалидацию)
-    cache_invalidation_dep()
-    cached = get_cache(cache_key)
+    cached = await get_cache(cache_key)
     if cached is not None:
-        return [date.fromisoformat(d) for d in cached]
+        return json_response(cached, encodings=encodings)
 
-    try:
-        async with async_session() as session:
-            result = await session.execute(
-                select(SpimexTradingResult.date).distinct().order_by(SpimexTradingResult.date.desc()).limit(limit)
-            )
-            dates = [row[0] for row in result.all()]
-    except SQLAlchemyError as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    async def load() -> bytes:
+        try:
+            async with read_session() as session:
+                result = await session.execute(
+                    select(TRADING_TABLE.c.date).distinct().order_by(TRADING_TABLE.c.date.desc()).limit(limit)
+                )
+                dates = [row[0] for row in result.all()]
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return compress_body(json_bytes(dates))
 
-    set_cache(cache_key, [d.isoformat() for d in dates])
-    return dates
+    return json_response(await single_flight(cache_key, load), encodings=encodings)
 
 @app.get("/results", response_model=List[TradingResult], summary="Результаты торгов (фильтрация)")
 async def api_get_trading_results(
@@ -171,6 +711,9 @@ async def api_get_trading_results(
         delivery_basis_id: Optional[str] = Query(None, description="код базы доставки (3 символа, позиции 5-7)"),
         date_value: Optional[date] = Query(None, description="Фильтр по точной дате (YYYY-MM-DD)"),
         limit: int = Query(100, ge=1, le=1000, description="Лимит записей для выдачи"),
+        cursor: Optional[str] = Query(None, description=f"Токен следующей страницы из заголовка {NEXT_CURSOR_HEADER}"),
+        fmt: str = Depends(response_format),
+        encodings: frozenset = Depends(accepted_encodings),
         _ = Depends(cache_invalidation_dep)
 ):
     """
@@ -181,23 +724,34 @@ async def api_get_trading_results(
       - delivery_basis_id: опционально
       - date_value: опционально
       - limit: опционально
+      - cursor: опционально, продолжение выдачи (новые даты раньше, постранично по limit)
+      - format: опционально, json / arrow / parquet (или через Accept)
     """
+    after = decode_cursor(cursor)
     cache_key = f"results:{oil_id}:{delivery_type_id}:{delivery_basis_id}:{date_value}:{limit}"
-    cached = get_cache(cache_key)
+    if cursor:
+        cache_key += f":{cursor}"
+    cache_key = format_key(cache_key, fmt)
+    cached = await get_cache(cache_key)
     if cached is not None:
-        return cached
-
-    try:
-        results = await get_trading_results(limit=limit, oil_id=oil_id,
-                                            delivery_type_id=delivery_type_id,
-                                            delivery_basis_id=delivery_basis_id,
-                                            date_value=date_value)
-    except SQLAlchemyError as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-    results_serialized = [model_to_serializable(r) for r in results]
-    set_cache(cache_key, results_serialized)
-    return results_serialized
+        body, page_cursor = unpack_page(cached)
+        return rows_response(body, fmt, page_cursor, encodings)
+
+    async def load() -> bytes:
+        try:
+            results = await get_trading_results(limit=limit, oil_id=oil_id,
+                                                delivery_type_id=delivery_type_id,
+                                                delivery_basis_id=delivery_basis_id,
+                                                date_value=date_value,
+                                                as_rows=True,
+                                                after=after)
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return pack_page(compress_body(rows_body(results, fmt)), next_cursor(results, limit))
+
+    scope = (date_value, date_value) if date_value else None
+    body, page_cursor = unpack_page(await single_flight(cache_key, load, scope))
+    return rows_response(body, fmt, page_cursor, encodings)
 
 
 @app.get("/dynamics", response_model=List[TradingResult], summary="Динамика торгов за период")
@@ -208,59 +762,169 @@ async def get_dynamics_api(
         delivery_type_id: Optional[str] = Query(None, description="Фильтр по delivery_type_id (опционально)"),
         delivery_basis_id: Optional[str] = Query(None, description="Фильтр по delivery_basis_id (опционально)"),
         limit: Optional[int] = Query(None, ge=1, le=10000, description="При желании ограничить количество результатов"),
+        cursor: Optional[str] = Query(None, description=f"Токен следующей страницы из заголовка {NEXT_CURSOR_HEADER}"),
+        fmt: str = Depends(response_format),
+        encodings: frozenset = Depends(accepted_encodings),
         _ = Depends(cache_invalidation_dep)
 ):
     """
     Возвращает список сделок за период [start_date, end_date].
     start_date и end_date — обязательны
     Остальные параметры — опциональны и уточняют выборку.
+    С limit выдача постраничная: если страница заполнена, в заголовке X-Next-Cursor приходит
+    токен, который передаётся в cursor для следующей страницы.
+    format=arrow|parquet (или Accept) — колоночный ответ для загрузки прямо в pandas.
     """
     if start_date > end_date:
         raise HTTPException(status_code=400, detail="start_date must be <= end_date")
 
+    after = decode_cursor(cursor)
     cache_key = f"dynamics:{start_date}:{end_date}:{oil_id}:{delivery_type_id}:{delivery_basis_id}:{limit}"
-    cached = get_cache(cache_key)
+    if cursor:
+        cache_key += f":{cursor}"
+    cache_key = format_key(cache_key, fmt)
+    cached = await get_cache(cache_key)
+    if cached is not None:
+        body, page_cursor = unpack_page(cached)
+        return rows_response(body, fmt, page_cursor, encodings)
+
+    async def load() -> bytes:
+        try:
+            results = await get_dynamics(start_date=start_date,
+                                         end_date=end_date,
+                                         oil_id=oil_id,
+                                         delivery_type_id=delivery_type_id,
+                                         delivery_basis_id=delivery_basis_id,
+                                         limit=limit,
+                                         as_rows=True,
+                                         after=after)
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=500,
+                                detail=str(e))
+        return pack_page(compress_body(rows_body(results, fmt)), next_cursor(results, limit))
+
+    body, page_cursor = unpack_page(await single_flight(cache_key, load, (start_date, end_date)))
+    return rows_response(body, fmt, page_cursor, encodings)
+
+
+# ---------- Потоковая выгрузка ----------
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+async def ndjson_chunks(batches):
+    """Пачки строк -> NDJSON, по одному куску байт на пачку"""
+    fields = TRADING_RESULT_FIELDS
+    async for rows in batches:
+        yield b"".join(orjson.dumps(dict(zip(fields, row)), option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+
+async def csv_chunks(batches):
+    """Пачки строк -> CSV с заголовком; даты пишутся в ISO-формате"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(TRADING_RESULT_FIELDS)
+    yield buffer.getvalue().encode()
+    async for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+
+
+@app.get("/dynamics/export", summary="Потоковая выгрузка сделок за период (NDJSON/CSV)")
+async def export_dynamics_api(
+        start_date: date = Query(..., description="Дата начала периода (YYYY-MM-DD) — обязательна"),
+        end_date: date = Query(..., description="Дата конца периода (YYYY-MM-DD) — обязательна"),
+        oil_id: Optional[str] = Query(None, description="Фильтр по oil_id (опционально)"),
+        delivery_type_id: Optional[str] = Query(None, description="Фильтр по delivery_type_id (опционально)"),
+        delivery_basis_id: Optional[str] = Query(None, description="Фильтр по delivery_basis_id (опционально)"),
+        format: Literal["ndjson", "csv"] = Query("ndjson", description="Формат выгрузки"),
+):
+    """
+    Те же фильтры, что у /dynamics, но без лимита и без кэша: строки читаются из БД серверным курсором
+    и сразу уходят клиенту, поэтому память не растёт с размером периода.
+    """
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must be <= end_date")
+
+    batches = stream_dynamics(start_date=start_date,
+                              end_date=end_date,
+                              oil_id=oil_id,
+                              delivery_type_id=delivery_type_id,
+                              delivery_basis_id=delivery_basis_id)
+    chunks = csv_chunks(batches) if format == "csv" else ndjson_chunks(batches)
+    filename = f"dynamics_{start_date}_{end_date}.{format}"
+    return StreamingResponse(chunks, media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.get("/dynamics/daily", response_model=List[DailyAggregate], summary="Дневные суммы торгов за период")
+async def get_daily_dynamics_api(
+        start_date: date = Query(..., description="Дата начала периода (YYYY-MM-DD) — обязательна"),
+        end_date: date = Query(..., description="Дата конца периода (YYYY-MM-DD) — обязательна"),
+        oil_id: Optional[str] = Query(None, description="Фильтр по oil_id (опционально)"),
+        delivery_type_id: Optional[str] = Query(None, description="Фильтр по delivery_type_id (опционально)"),
+        delivery_basis_id: Optional[str] = Query(None, description="Фильтр по delivery_basis_id (опционально)"),
+        group_by: List[Literal["oil_id", "delivery_basis_id", "delivery_type_id"]] = Query(
+            ["oil_id"], description="Измерения группировки помимо даты"),
+        encodings: frozenset = Depends(accepted_encodings),
+        _ = Depends(cache_invalidation_dep)
+):
+    """
+    Возвращает дневные суммы объёма, стоимости и количества сделок за период [start_date, end_date]
+    и средневзвешенную цену vwap = total / volume. Читает предрассчитанную дневную сводку,
+    а не исходные строки торгов.
+    """
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must be <= end_date")
+
+    dimensions = sorted(set(group_by))
+    cache_key = (f"dynamics_daily:{start_date}:{end_date}:{oil_id}:{delivery_type_id}:{delivery_basis_id}:"
+                 f"{','.join(dimensions)}")
+    cached = await get_cache(cache_key)
     if cached is not None:
-        return cached
+        return json_response(cached, encodings=encodings)
 
-    try:
-        results = await get_dynamics(start_date=start_date,
-                                     end_date=end_date,
-                                     oil_id=oil_id,
-                                     delivery_type_id=delivery_type_id,
-                                     delivery_basis_id=delivery_basis_id,
-                                     limit=limit)
-    except SQLAlchemyError as e:
-        raise HTTPException(status_code=500,
-                            detail=str(e))
+    async def load() -> bytes:
+        try:
+            rows = await get_daily_aggregates(start_date=start_date,
+                                              end_date=end_date,
+                                              oil_id=oil_id,
+                                              delivery_type_id=delivery_type_id,
+                                              delivery_basis_id=delivery_basis_id,
+                                              group_by=dimensions)
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return compress_body(json_bytes([{field: row.get(field) for field in DAILY_AGGREGATE_FIELDS} for row in rows]))
 
-    results_serialized = [model_to_serializable(r) for r in results]
-    set_cache(cache_key, results_serialized)
-    return results_serialized
+    return json_response(await single_flight(cache_key, load, (start_date, end_date)), encodings=encodings)
 
 
 @app.get("/last_results", response_model=List[TradingResult], summary="Результаты за последнюю дату торгов")
-async def get_last_trading_results(_ = Depends(cache_invalidation_dep)):
+async def get_last_trading_results(fmt: str = Depends(response_format),
+                                   encodings: frozenset = Depends(accepted_encodings),
+                                   _ = Depends(cache_invalidation_dep)):
     """
     Возвращает все записи за последнюю дату торгов (определяется автоматически).
+    format=arrow|parquet (или Accept) — колоночный ответ.
     """
-    cache_key = "last_results"
-    cached = get_cache(cache_key)
+    cache_key = format_key("last_results", fmt)
+    cached = await get_cache(cache_key)
     if cached is not None:
-        return cached
+        return rows_response(cached, fmt, encodings=encodings)
 
-    last_date = await get_last_trading_date()
-    if not last_date:
-        raise HTTPException(status_code=404, detail="No trading data found")
+    async def load() -> bytes:
+        last_date = await get_last_trading_date()
+        if not last_date:
+            raise HTTPException(status_code=404, detail="No trading data found")
 
-    try:
-        results = await get_trading_results(limit=10000, date_value=last_date)
-    except SQLAlchemyError as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        try:
+            results = await get_trading_results(limit=10000, date_value=last_date, as_rows=True)
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return compress_body(rows_body(results, fmt))
 
-    results_serialized = [model_to_serializable(r) for r in results]
-    set_cache(cache_key, results_serialized)
-    return results_serialized
+    return rows_response(await single_flight(cache_key, load), fmt, encodings=encodings)
 
 
 if __name__ == "__main__":
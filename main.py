@@ -1,9 +1,19 @@
 import asyncio
 import datetime
+import hashlib
+import json
 import os
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
+
 import aiohttp
+import httpx
 
-from DB_interface import create_tables, parse_to_db
+from api_cache import ACCESS_STATS_KEY, decay_access_stats, publish_data_changed
+from DB_interface import (DB_REPLICA_WAIT, create_tables, get_trading_dates, parse_to_db, primary_reads,
+                          trade_date_from_filename, wait_for_replica)
 
 # https://spimex.com/upload/reports/oil_xls/oil_xls_20250722162000.xls
 # Дата торгов: 22.07.2025
@@ -11,55 +21,416 @@ from DB_interface import create_tables, parse_to_db
 # reporting_date = datetime.datetime.now().strftime("%Y%m%d")  # 20250722
 # url = f"https://spimex.com/upload/reports/oil_xls/oil_xls_{reporting_date}162000.xls"
 
+# Число процессов для чтения и разбора xls
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+# Сколько файлов одновременно записывается в БД
+DB_WRITE_CONCURRENCY = int(os.getenv("DB_WRITE_CONCURRENCY", 4))
+
+
+# full — перекачать весь период, incremental — только дни, которых нет в БД и в манифесте
+SYNC_MODE = os.getenv("SYNC_MODE", "full")
+SYNC_START_DATE = os.getenv("SYNC_START_DATE", "20250701")
+# Локальный список дней, за которые бюллетеня нет (404: выходные, праздники)
+SYNC_MANIFEST = os.getenv("SYNC_MANIFEST", "sync_manifest.json")
+
+# Настройки загрузчика: общее ограничение параллельности, таймаут запроса, повторы
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 5))
+DOWNLOAD_PER_HOST = int(os.getenv("DOWNLOAD_PER_HOST", 5))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 30))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", 0.5))
+# Ответы, означающие «бюллетеня за этот день нет» (только они попадают в манифест)
+NO_DATA_STATUSES = (404, 410)
+# Потолок ожидания по заголовку Retry-After ответа 429, секунды
+DOWNLOAD_MAX_RETRY_AFTER = float(os.getenv("DOWNLOAD_MAX_RETRY_AFTER", 60))
+# Начальный и максимальный размер чунка при потоковом чтении ответа
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 64 * 1024))
+DOWNLOAD_MAX_CHUNK_SIZE = int(os.getenv("DOWNLOAD_MAX_CHUNK_SIZE", 1024 * 1024))
+# Сохранять ли скачанные xls на диск (для аудита); разбор в любом случае идёт из памяти
+DOWNLOAD_KEEP_FILES = os.getenv("DOWNLOAD_KEEP_FILES", "1").lower() in ("1", "true", "yes")
+# Файл кэша загрузок (ETag / Last-Modified / хэши по url)
+DOWNLOAD_CACHE = os.getenv("DOWNLOAD_CACHE", "download_cache.json")
+# Как часто (секунды) сохранять кэш загрузок во время прогона; в конце прогона он сохраняется всегда
+DOWNLOAD_CACHE_FLUSH_INTERVAL = float(os.getenv("DOWNLOAD_CACHE_FLUSH_INTERVAL", 5))
+
+
+class DownloadCache:
+    """
+    Кэш загрузок по url: ETag, Last-Modified, sha256 файла на диске и sha256 последней версии,
+    загруженной в БД (ingested). Изменения копятся в памяти, flush() пишет файл в потоке
+    (не чаще раза в flush_interval секунд), поэтому при сбое теряются только последние секунды —
+    такие файлы просто скачаются и загрузятся повторно.
+    """
+
+    def __init__(self, path=None, flush_interval: float = DOWNLOAD_CACHE_FLUSH_INTERVAL):
+        self.path = path or DOWNLOAD_CACHE
+        self.flush_interval = flush_interval
+        self.entries = {}
+        self.dirty = False
+        self._flushed_at = time.monotonic()
+        self._write_lock = asyncio.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def update(self, url, **fields):
+        self.entries.setdefault(url, {}).update(fields)
+        self.dirty = True
+
+    def is_ingested(self, url):
+        entry = self.entries.get(url)
+        return bool(entry) and entry.get("sha256") is not None and entry.get("ingested") == entry["sha256"]
+
+    def mark_ingested(self, url):
+        entry = self.entries.get(url)
+        if entry and entry.get("sha256"):
+            entry["ingested"] = entry["sha256"]
+            self.dirty = True
+
+    async def flush(self, force: bool = True):
+        """Сохраняет изменения; без force — только если с прошлого сохранения прошло flush_interval"""
+        if not self.dirty or (not force and time.monotonic() - self._flushed_at < self.flush_interval):
+            return
+        self.dirty = False
+        self._flushed_at = time.monotonic()
+        # снимок делаем в event loop: в потоке entries могли бы меняться во время сериализации
+        data = json.dumps(self.entries, indent=2)
+        async with self._write_lock:
+            await asyncio.to_thread(self._write, data)
+
+    def _write(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
 
-filenames = []
-async def download_files(session, url):
-    semaphore = asyncio.Semaphore(5)
-    async with semaphore:
+def retry_after_seconds(value):
+    """Пауза из заголовка Retry-After (число секунд или HTTP-дата); None, если заголовка нет или он не разобран"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return max((moment - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+
+def _write_file(filename, content):
+    with open(filename, 'wb') as f:
+        f.write(content)
+
+
+class Downloader:
+    """
+    Загрузчик файлов биржи: один семафор на все загрузки, пул соединений с keep-alive,
+    таймаут на запрос и повторы с экспоненциальной задержкой на 5xx, 429 и сетевых ошибках
+    (на 429 ждём не меньше, чем просит Retry-After, но не дольше DOWNLOAD_MAX_RETRY_AFTER).
+    """
+
+    def __init__(self, concurrency: int = DOWNLOAD_CONCURRENCY, per_host: int = DOWNLOAD_PER_HOST,
+                 timeout: float = DOWNLOAD_TIMEOUT, retries: int = DOWNLOAD_RETRIES,
+                 backoff: float = DOWNLOAD_BACKOFF, cache: DownloadCache = None,
+                 keep_files: bool = DOWNLOAD_KEEP_FILES, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                 max_chunk_size: int = DOWNLOAD_MAX_CHUNK_SIZE):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.keep_files = keep_files
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.stats = {"ok": 0, "missing": 0, "errors": 0, "retries": 0, "bytes": 0, "not_modified": 0}
+        # url, на которые сервер ответил 404/410 (бюллетеня за этот день нет)
+        self.missing = []
+        self.started = time.monotonic()
+
+    def session(self):
+        """ClientSession с настроенным пулом соединений и таймаутом на запрос."""
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         limit_per_host=self.per_host,
+                                         ttl_dns_cache=300,
+                                         keepalive_timeout=30)
+        return aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def _conditional_headers(self, url, filename):
+        """If-None-Match / If-Modified-Since, если файл уже скачан (или загружен в БД) и есть в кэше"""
+        entry = self.cache.get(url) if self.cache else None
+        if not entry or not (os.path.exists(filename) or self.cache.is_ingested(url)):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    async def _read_body(self, response):
+        """Читает тело ответа чунками, увеличивая их размер, пока сервер отдаёт полные чунки."""
+        chunks = []
+        chunk_size = self.chunk_size
+        while True:
+            chunk = await response.content.read(chunk_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if len(chunk) == chunk_size and chunk_size < self.max_chunk_size:
+                chunk_size = min(chunk_size * 2, self.max_chunk_size)
+        return b"".join(chunks)
+
+    async def download(self, session, url):
+        """
+        Скачивает url в файл с тем же именем. Возвращает имя файла, если его нужно разобрать,
+        иначе None (ошибка, нет данных или файл не изменился с последней загрузки в БД).
+        """
+        filename, _ = await self.fetch(session, url)
+        return filename
+
+    async def fetch(self, session, url):
+        """
+        Как download, но возвращает (имя файла, содержимое). Содержимое можно сразу отдать
+        парсеру без чтения с диска; оно None, если актуальный файл уже лежит на диске (ответ 304).
+        """
         filename = os.path.join(url.split("/")[-1])
-        try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    filenames.append(filename)
-
-                    with open(filename, 'wb') as f:
-                        while True:
-                            chunk = await response.content.read(1024)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                    print(f"Успешно: {filename}")
-                else:
-                    print(f"Ошибка {response.status}: {url}")
-        except Exception as e:
-            print(f"Ошибка при загрузке {url}: {str(e)}")
+        headers = self._conditional_headers(url, filename)
+        request_kwargs = {"headers": headers} if headers else {}
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                delay = self.backoff * 2 ** attempt
+                try:
+                    async with session.get(url, **request_kwargs) as response:
+                        if response.status == 304 and headers:
+                            self.stats["not_modified"] += 1
+                            if self.cache.is_ingested(url):
+                                print(f"Не изменился: {filename}")
+                                return None, None
+                            # файл на диске актуален, но в БД ещё не загружен
+                            return filename, None
+                        if response.status == 200:
+                            content = await self._read_body(response)
+                            self.stats["bytes"] += len(content)
+                            if self.keep_files:
+                                # запись на диск не блокирует event loop
+                                await asyncio.to_thread(_write_file, filename, content)
+                            self.stats["ok"] += 1
+                            print(f"Успешно: {filename}")
+
+                            if self.cache:
+                                self.cache.update(url,
+                                                  etag=response.headers.get("ETag"),
+                                                  last_modified=response.headers.get("Last-Modified"),
+                                                  sha256=hashlib.sha256(content).hexdigest())
+                                if self.cache.is_ingested(url):
+                                    print(f"Содержимое не изменилось: {filename}")
+                                    return None, None
+                            return filename, content
+                        # 429 — биржа ограничивает частоту запросов, повторяем как 5xx
+                        retryable = response.status >= 500 or response.status == 429
+                        if not retryable or attempt == self.retries:
+                            # 404/410 — торгов в этот день не было, повторять бессмысленно;
+                            # прочие 4xx (403, 408 ...) — ошибка, день не считается неторговым
+                            if response.status in NO_DATA_STATUSES:
+                                self.stats["missing"] += 1
+                                self.missing.append(url)
+                            else:
+                                self.stats["errors"] += 1
+                            print(f"Ошибка {response.status}: {url}")
+                            return None, None
+                        if response.status == 429:
+                            retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                            if retry_after is not None:
+                                delay = max(delay, min(retry_after, DOWNLOAD_MAX_RETRY_AFTER))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.retries:
+                        self.stats["errors"] += 1
+                        print(f"Ошибка при загрузке {url}: {str(e)}")
+                        return None, None
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"Ошибка при загрузке {url}: {str(e)}")
+                    return None, None
+
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
 
+    def report(self):
+        """Печатает итог: число файлов, объём, скорость и ошибки."""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        megabytes = self.stats["bytes"] / 1024 / 1024
+        print(f"Загружено файлов: {self.stats['ok']} ({megabytes:.1f} МБ за {elapsed:.1f} с, "
+              f"{megabytes / elapsed:.2f} МБ/с, {self.stats['ok'] / elapsed:.2f} файл/с); "
+              f"нет данных: {self.stats['missing']}, ошибок: {self.stats['errors']}, "
+              f"повторов: {self.stats['retries']}, не изменились (304): {self.stats['not_modified']}")
 
-async def main():
+
+# Общий загрузчик на event loop, чтобы ограничение действовало на все вызовы download_files
+_downloaders = weakref.WeakKeyDictionary()
+
+
+def get_downloader():
+    loop = asyncio.get_running_loop()
+    if loop not in _downloaders:
+        _downloaders[loop] = Downloader()
+    return _downloaders[loop]
+
+
+async def download_files(session, url, downloader=None):
+    return await (downloader or get_downloader()).download(session, url)
+
+
+async def fetch_file(session, url, downloader=None):
+    return await (downloader or get_downloader()).fetch(session, url)
+
+
+def bulletin_url(day):
+    return f"https://spimex.com/upload/reports/oil_xls/oil_xls_{day.strftime('%Y%m%d')}162000.xls"
+
+
+def load_manifest(path=None):
+    """Даты без бюллетеня из локального манифеста"""
+    path = path or SYNC_MANIFEST
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {datetime.date.fromisoformat(d) for d in json.load(f).get("no_data_dates", [])}
+
+
+def save_manifest(dates, path=None):
+    with open(path or SYNC_MANIFEST, "w", encoding="utf-8") as f:
+        json.dump({"no_data_dates": sorted(d.isoformat() for d in dates)}, f, indent=2)
+
+
+async def download_and_parse(session, url, executor, write_semaphore, downloader=None):
+    """
+    Скачивает файл и сразу отправляет его на разбор, не дожидаясь остальных загрузок.
+    Содержимое передаётся парсеру из памяти, без повторного чтения файла с диска.
+    Возвращает дату торгов, если в БД что-то добавилось или обновилось (для инвалидации кэша API).
+    """
+    filename, content = await fetch_file(session, url, downloader=downloader)
+    if filename:
+        counts = await parse_to_db(filename, executor=executor, write_semaphore=write_semaphore, content=content)
+        if counts is not None and downloader and downloader.cache:
+            downloader.cache.mark_ingested(url)
+            await downloader.cache.flush(force=False)
+        if counts and (counts.get('inserted') or counts.get('updated')):
+            return trade_date_from_filename(filename)
+
+
+# Прогрев кэша API после загрузки: всегда прогреваемые запросы плюс CACHE_WARMUP_TOP самых частых из статистики
+CACHE_WARMUP = os.getenv("CACHE_WARMUP", "1") == "1"
+CACHE_WARMUP_TOP = int(os.getenv("CACHE_WARMUP_TOP", 20))
+CACHE_WARMUP_CONCURRENCY = int(os.getenv("CACHE_WARMUP_CONCURRENCY", 4))
+CACHE_WARMUP_PATHS = ("/last_results", "/last_dates")
+
+
+async def warm_up_cache(top: int = None):
+    """
+    Заранее считает популярные ответы API, чтобы первые запросы после загрузки попали в кэш.
+    Запросы прогоняются через само приложение (без сети), поэтому ключи и тела ответов
+    получаются ровно такими же, как при обычном обращении к app.py.
+    """
+    import app as api
+
+    top = CACHE_WARMUP_TOP if top is None else top
+    await api.connect_redis()
+    if api.redis is None:
+        print("Прогрев кэша пропущен: Redis недоступен")
+        return
+    try:
+        popular = await api.redis.zrevrange(ACCESS_STATS_KEY, 0, top - 1) if top > 0 else []
+        await decay_access_stats(api.redis)
+        paths = list(dict.fromkeys([*CACHE_WARMUP_PATHS, *(p.decode() for p in popular)]))
+        semaphore = asyncio.Semaphore(CACHE_WARMUP_CONCURRENCY)
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://warmup",
+                                     headers={api.WARMUP_HEADER: "1"}) as client:
+            async def warm(path):
+                async with semaphore:
+                    try:
+                        return (await client.get(path)).status_code == 200
+                    except Exception as e:
+                        print(f"Ошибка прогрева {path}: {e}")
+                        return False
+
+            # реплика может ещё не догнать только что загруженные данные
+            with primary_reads():
+                results = await asyncio.gather(*(warm(path) for path in paths))
+        print(f"Прогрев кэша: {sum(results)} из {len(paths)} запросов")
+    finally:
+        await api.close_redis()
+
+
+async def main(mode: str = None):
+    mode = mode or SYNC_MODE
     # создание БД
     await create_tables()
 
     # загрузка файлов
-    start_date = datetime.datetime.strptime("20250701", "%Y%m%d")
+    start_date = datetime.datetime.strptime(SYNC_START_DATE, "%Y%m%d")
     end_date = datetime.datetime.now()
     curent_date = start_date
-    urls = []
+    days = []
     while curent_date <= end_date:
-        reporting_date = curent_date.strftime("%Y%m%d")
-        url = f"https://spimex.com/upload/reports/oil_xls/oil_xls_{reporting_date}162000.xls"
-        urls.append(url)
+        days.append(curent_date.date())
         curent_date += datetime.timedelta(days=1)
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [download_files(session, url) for url in urls]
-        await asyncio.gather(*tasks)
+    no_data_dates = set()
+    if mode == "incremental":
+        # пропускаем дни, которые уже есть в БД, и дни, за которые бюллетеня точно нет
+        no_data_dates = load_manifest()
+        held = await get_trading_dates(days[0], days[-1]) if days else set()
+        days = [d for d in days if d not in held and d not in no_data_dates]
+        print(f"Инкрементальная синхронизация: к загрузке {len(days)} дн.")
+    urls = [bulletin_url(d) for d in days]
 
+    # загрузка и заполнение бд идут параллельно: xls разбираются в пуле процессов,
+    # записи в БД ограничены DB_WRITE_CONCURRENCY
+    write_semaphore = asyncio.Semaphore(DB_WRITE_CONCURRENCY)
+    downloader = Downloader(cache=DownloadCache())
+    with ProcessPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+        async with downloader.session() as session:
+            tasks = [download_and_parse(session, url, executor, write_semaphore, downloader) for url in urls]
+            try:
+                changed = {day for day in await asyncio.gather(*tasks) if day}
+            finally:
+                await downloader.cache.flush()
+    downloader.report()
+
+    # одно событие на прогон: API сбросит только ключи, затронутые изменёнными датами
+    if changed:
+        # API читает с реплики: событие отправляем, когда она увидит загруженные строки.
+        # Недоступная реплика, как и Redis, не должна отменять сброс кэша после загрузки.
+        try:
+            caught_up = await wait_for_replica()
+        except Exception as e:
+            print(f"Ошибка проверки реплики: {e}")
+            caught_up = False
+        if not caught_up:
+            print(f"Реплика не догнала основную БД за {DB_REPLICA_WAIT:.0f} с, кэш API сбрасывается без ожидания")
+        await publish_data_changed(changed)
+        if CACHE_WARMUP:
+            await warm_up_cache()
 
-    # заполнение бд
-    for filename in filenames:
-        await parse_to_db(filename)
+    if mode == "incremental":
+        # сегодняшний бюллетень может появиться позже, в манифест его не записываем
+        today = end_date.date()
+        url_days = dict(zip(urls, days))
+        no_data_dates |= {url_days[url] for url in downloader.missing if url_days[url] < today}
+        save_manifest(no_data_dates)
 
 
 if __name__ == "__main__":
     asyncio.run(main())
-    # print(filenames)
@@ -95,7 +95,25 @@ def mock_cached_dates():
 @pytest.fixture(autouse=True)
 def common_mocks():
     """Общие моки для всех тестов"""
+    from app import local_cache
+
+    local_cache.clear()
     with patch('app.cache_invalidation_dep'), \
             patch('app.get_cache', return_value=None), \
             patch('app.set_cache'):
         yield
+
+
+# фикстура для тестов на реальной БД (postgres)
+@pytest.fixture
+async def real_db():
+    """Создаёт таблицы в реальной БД и закрывает пул соединений после теста"""
+    import DB_interface as db
+
+    # соединения, оставшиеся в пуле от event loop предыдущего теста, использовать нельзя
+    await db.engine.dispose(close=False)
+    await db.read_engine.dispose(close=False)
+    await db.create_tables()
+    yield db
+    await db.engine.dispose()
+    await db.read_engine.dispose()
@@ -1,5 +1,14 @@
-from sqlalchemy import inspect
+import asyncio
+import io
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect, delete, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
 import pytest
+from unittest.mock import patch
 
 import DB_interface as db
 
@@ -27,4 +36,417 @@ async def test_create_tables_real_db():
 # строки 49 - 135
 
 
+def make_record(product_id, trade_date, count=1):
+    return {
+        'exchange_product_id': product_id,
+        'exchange_product_name': 'Тестовый продукт',
+        'oil_id': product_id[:4],
+        'delivery_basis_id': product_id[4:7],
+        'delivery_basis_name': 'Тестовая база',
+        'delivery_type_id': product_id[-1],
+        'volume': 10.0,
+        'total': 1000.0,
+        'count': count,
+        'date': trade_date
+    }
+
+
+@pytest.mark.asyncio
+async def test_save_records_counts_inserted_and_skipped(real_db):
+    trade_date = date(1999, 1, 4)
+    records = [make_record('TST1ABC', trade_date), make_record('TST2ABC', trade_date)]
+    try:
+        first = await real_db.save_records(records)
+        second = await real_db.save_records(records + [make_record('TST3ABC', trade_date)])
+        updated = await real_db.save_records([make_record('TST1ABC', trade_date, count=5)], on_conflict='update')
+
+        assert first == {'inserted': 2, 'updated': 0, 'skipped': 0}
+        assert second == {'inserted': 1, 'updated': 0, 'skipped': 2}
+        assert updated == {'inserted': 0, 'updated': 1, 'skipped': 0}
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date == trade_date))
+            await session.commit()
+
+
+
+@pytest.mark.asyncio
+async def test_get_trading_dates(real_db):
+    days = [date(1999, 1, 5), date(1999, 1, 7)]
+    try:
+        await real_db.save_records([make_record('TST1ABC', d) for d in days])
+
+        assert await real_db.get_trading_dates(date(1999, 1, 1), date(1999, 1, 31)) == set(days)
+        assert await real_db.get_trading_dates(date(1999, 1, 6), date(1999, 1, 31)) == {date(1999, 1, 7)}
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date.in_(days)))
+            await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_get_dynamics_as_rows(real_db):
+    trade_date = date(1999, 1, 8)
+    record = make_record('TST1ABCF', trade_date)
+    record['volume'] = 10.5
+    try:
+        await real_db.save_records([record])
+
+        rows = await real_db.get_dynamics(trade_date, trade_date, oil_id='TST1', as_rows=True)
+        entities = await real_db.get_dynamics(trade_date, trade_date, oil_id='TST1')
+        results = await real_db.get_trading_results(date_value=trade_date, oil_id='TST1', as_rows=True)
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date == trade_date))
+            await session.commit()
+
+    # только колонки API, Numeric уже float; ORM-путь остаётся доступным
+    assert list(rows[0]._fields) == [c.key for c in real_db.API_COLUMNS]
+    assert rows[0].volume == 10.5 and isinstance(rows[0].total, float)
+    assert rows[0].date == trade_date
+    assert entities[0].id == rows[0].id and float(entities[0].volume) == 10.5
+    assert list(results) == list(rows)
+
+
+@pytest.mark.asyncio
+async def test_keyset_pagination(real_db):
+    days = [date(1999, 1, 11), date(1999, 1, 12)]
+    records = [make_record(f'TST{i}ABCF', d) for d in days for i in range(3)]
+    try:
+        await real_db.save_records(records)
+
+        pages, after = [], None
+        while True:
+            page = await real_db.get_dynamics(days[0], days[-1], as_rows=True, limit=2, after=after)
+            if not page:
+                break
+            pages.append(page)
+            after = (page[-1].date, page[-1].id)
+        everything = await real_db.get_dynamics(days[0], days[-1], as_rows=True)
+
+        first = await real_db.get_trading_results(limit=4, oil_id=None, as_rows=True, after=(days[-1], 10 ** 9))
+        rest = await real_db.get_trading_results(limit=4, as_rows=True, after=(first[-1].date, first[-1].id))
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date.in_(days)))
+            await session.commit()
+
+    # страницы идут без пропусков и повторов и в сумме дают полную выдачу
+    assert [len(p) for p in pages] == [2, 2, 2]
+    assert [row for p in pages for row in p] == list(everything)
+    # /results — в обратном порядке
+    assert [(r.date, r.id) for r in first + rest][:6] == sorted(((r.date, r.id) for r in everything), reverse=True)
+
+
+@pytest.mark.asyncio
+async def test_stream_dynamics(real_db):
+    days = [date(1999, 1, 13), date(1999, 1, 14)]
+    records = [make_record(f'TST{i}ABCF', d) for d in days for i in range(3)]
+    try:
+        await real_db.save_records(records)
+
+        batches = [rows async for rows in real_db.stream_dynamics(days[0], days[-1], batch_size=4)]
+        everything = await real_db.get_dynamics(days[0], days[-1], as_rows=True)
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date.in_(days)))
+            await session.commit()
+
+    assert [len(rows) for rows in batches] == [4, 2]
+    assert [row for rows in batches for row in rows] == list(everything)
+
+
+@pytest.mark.asyncio
+async def test_daily_aggregates(real_db):
+    trade_date = date(1999, 1, 6)
+    records = [make_record('TST1ABCF', trade_date, count=2), make_record('TST1XYZF', trade_date, count=3),
+               make_record('TST2ABCF', trade_date, count=1)]
+    records[1]['total'] = 3000.0
+    try:
+        # сводка пересчитывается самой записью
+        await real_db.save_records(records)
+
+        by_oil = await real_db.get_daily_aggregates(trade_date, trade_date)
+        by_basis = await real_db.get_daily_aggregates(trade_date, trade_date, oil_id='TST1',
+                                                      group_by=('oil_id', 'delivery_basis_id'))
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date == trade_date))
+            await session.commit()
+        await real_db.refresh_daily_aggregates({trade_date})
+
+    assert [(r['oil_id'], r['volume'], r['total'], r['count'], r['vwap']) for r in by_oil] == [
+        ('TST1', 20, 4000, 5, 200), ('TST2', 10, 1000, 1, 100)
+    ]
+    assert [(r['delivery_basis_id'], r['count']) for r in by_basis] == [('ABC', 2), ('XYZ', 3)]
+    assert await real_db.get_daily_aggregates(trade_date, trade_date) == []
+
+
+@pytest.mark.asyncio
+async def test_save_records_rolls_back_with_aggregates(real_db):
+    trade_date = date(1999, 1, 7)
+    with patch.object(real_db, '_refresh_daily_aggregates', side_effect=RuntimeError("refresh failed")):
+        with pytest.raises(RuntimeError):
+            await real_db.save_records([make_record('TST1ABC', trade_date)])
+
+    # строки не зафиксированы без сводки, поэтому повторная загрузка файла вставит их заново
+    assert await real_db.get_trading_dates(trade_date, trade_date) == set()
+
+def make_sheet_row(code, volume=60.0, total=3000000.0, count=2):
+    row = [np.nan] * 15
+    row[1], row[2], row[3] = code, 'Бензин', 'ст. Новая'
+    row[4], row[5], row[14] = volume, total, count
+    return row
+
+
+def make_trade_summary():
+    """Лист TRADE_SUMMARY: заголовок секции, суммарные строки, прочерки и некорректные значения"""
+    header = [np.nan] * 15
+    header[1] = 'Единица измерения: Метрическая тонна'
+    rows = [[np.nan] * 15, header, [np.nan] * 15, [np.nan] * 15,
+            make_sheet_row('A100NVY060F'),
+            make_sheet_row('Итого:', count=5),
+            make_sheet_row('Итого по секции:', count=3),
+            make_sheet_row('-'),
+            make_sheet_row('B200ABC001A', count='-'),
+            make_sheet_row(np.nan),
+            make_sheet_row('C300ABC001B', volume='1 000', total='2 500,5', count=1),
+            make_sheet_row('D400XYZ002C', volume='1 000', total='2 500.5', count='3'),
+            make_sheet_row('E500QQQ003D', count=0),
+            make_sheet_row(' G700ZZZ004E ', volume=np.nan, total=np.nan, count=' 4 '),
+            make_sheet_row('H800ABC005F', count='1.0')]
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize("parser", ["loop", "vectorized"])
+def test_parse_trade_summary_records(parser):
+    records = db.parse_trade_summary(make_trade_summary(), date(2025, 7, 1), parser=parser)
+
+    assert [r['exchange_product_id'] for r in records] == ['A100NVY060F', 'D400XYZ002C', 'G700ZZZ004E']
+    assert records[1]['volume'] == 1000.0 and records[1]['total'] == 2500.5 and records[1]['count'] == 3
+    assert records[2]['volume'] == 0 and records[2]['count'] == 4
+    assert (records[0]['oil_id'], records[0]['delivery_basis_id'], records[0]['delivery_type_id']) == \
+           ('A100', 'NVY', 'F')
+
+
+def test_parse_trade_summary_engines_match():
+    df = make_trade_summary()
+    trade_date = date(2025, 7, 1)
+
+    assert db.parse_trade_summary(df, trade_date, parser='vectorized') == \
+           db.parse_trade_summary(df, trade_date, parser='loop')
+
+
+def test_parse_trade_summary_without_metric_ton_section():
+    df = pd.DataFrame([[np.nan, 'Форма', np.nan]])
+
+    assert db.parse_trade_summary(df, date(2025, 7, 1)) is None
+
+
+def test_extract_records_from_memory(monkeypatch):
+    sources = []
+
+    def fake_read(source):
+        sources.append(source)
+        return make_trade_summary()
+
+    monkeypatch.setattr(db, "read_trade_summary", fake_read)
+    records = db.extract_records("downloads/oil_xls_20250701162000.xls", content=b"xls-bytes")
+
+    # файл не читается с диска, дата берётся из имени
+    assert isinstance(sources[0], io.BytesIO) and sources[0].getvalue() == b"xls-bytes"
+    assert records[0]['date'] == date(2025, 7, 1)
+
+
+
+@pytest.mark.asyncio
+async def test_migrate_adds_missing_indexes(real_db):
+    dropped = 'ix_instrument_oil' if db.DB_NORMALIZED else 'ix_spimex_oil_date'
+    async with real_db.engine.begin() as conn:
+        await conn.execute(text(f"DROP INDEX IF EXISTS {dropped}"))
+
+    await real_db.migrate()
+
+    def all_indexes(sync_conn):
+        inspector = inspect(sync_conn)
+        return {ix['name'] for table in inspector.get_table_names() for ix in inspector.get_indexes(table)}
+
+    async with real_db.engine.connect() as conn:
+        indexes = await conn.run_sync(all_indexes)
+    if db.DB_NORMALIZED:
+        assert {'ix_spimex_date', 'uq_spimex_product_date', 'ix_instrument_oil',
+                'ix_instrument_basis', 'ix_instrument_type'} <= indexes
+    else:
+        assert {'ix_spimex_date', 'ix_spimex_oil_date', 'ix_spimex_basis_date',
+                'ix_spimex_type_date', 'uq_spimex_product_date'} <= indexes
+
+async def explain(conn, query):
+    sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    result = await conn.execute(text(f"EXPLAIN {sql}"))
+    return "\n".join(row[0] for row in result)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", [
+    db.dynamics_query(date(2025, 7, 1), date(2025, 7, 31)),
+    db.dynamics_query(date(2025, 7, 1), date(2025, 7, 31), oil_id='A100', limit=100),
+    db.dynamics_query(date(2025, 7, 1), date(2025, 7, 31), delivery_basis_id='NVY'),
+    db.dynamics_query(date(2025, 7, 1), date(2025, 7, 31), delivery_type_id='F'),
+    db.trading_results_query(limit=100),
+    db.trading_results_query(limit=100, date_value=date(2025, 7, 1)),
+    select(db.SpimexTradingResult.date).distinct().order_by(db.SpimexTradingResult.date.desc()).limit(10),
+])
+async def test_read_queries_use_indexes(real_db, query):
+    await real_db.ensure_partitions([date(2025, 7, 1)])
+    async with real_db.engine.connect() as conn:
+        # на маленькой таблице планировщик всё равно выберет seq scan, запрещаем его
+        await conn.execute(text("SET enable_seqscan = off"))
+        plan = await explain(conn, query)
+
+    assert "Seq Scan" not in plan
+    assert "Index" in plan
+
+
+def test_partition_bounds():
+    assert db.partition_bounds(date(2025, 12, 17)) == \
+           ('spimex_trading_results_2025_12', date(2025, 12, 1), date(2026, 1, 1))
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not db.DB_PARTITIONED, reason="таблица создана без секционирования (DB_PARTITIONED=0)")
+async def test_dynamics_query_prunes_partitions(real_db):
+    days = [date(1999, 1, 4), date(1999, 2, 4)]
+    try:
+        await real_db.save_records([make_record('TST1ABC', d) for d in days])
+        async with real_db.engine.connect() as conn:
+            plan = await explain(conn, db.dynamics_query(date(1999, 1, 1), date(1999, 1, 31)))
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date.in_(days)))
+            await session.commit()
+
+    assert 'spimex_trading_results_1999_01' in plan
+    assert 'spimex_trading_results_1999_02' not in plan
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not db.DB_NORMALIZED, reason="таблицы созданы в широкой схеме (DB_NORMALIZED=0)")
+async def test_normalized_schema_upserts_instruments(real_db):
+    days = [date(1999, 1, 4), date(1999, 1, 5)]
+    instruments = real_db.SpimexInstrument.__table__
+    try:
+        await real_db.save_records([make_record('TST1ABC', d) for d in days])
+        renamed = {**make_record('TST1ABC', days[1]), 'exchange_product_name': 'Новое имя'}
+        await real_db.save_records([renamed], on_conflict='update')
+        results = await real_db.get_dynamics(days[0], days[1], oil_id='TST1')
+        async with real_db.async_session() as session:
+            rows = (await session.execute(
+                select(instruments).where(instruments.c.exchange_product_id == 'TST1ABC'))).all()
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date.in_(days)))
+            await session.execute(delete(instruments).where(instruments.c.exchange_product_id == 'TST1ABC'))
+            await session.commit()
+        real_db._known_instruments.discard('TST1ABC')
+
+    # одна строка справочника на инструмент, а чтение отдаёт прежние широкие строки
+    assert len(rows) == 1
+    assert [(r.exchange_product_id, r.exchange_product_name, r.delivery_basis_id, r.date) for r in results] == [
+        ('TST1ABC', 'Новое имя', 'ABC', days[0]),
+        ('TST1ABC', 'Новое имя', 'ABC', days[1]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_reads_route_to_replica(real_db):
+    with patch.object(real_db, 'replica_session', wraps=real_db.async_session) as replica:
+        await real_db.get_last_trading_date()
+        await real_db.get_trading_results(limit=1)
+        assert replica.call_count == 2
+
+        # сразу после загрузки (прогрев кэша) читаем из основной БД
+        with real_db.primary_reads():
+            await real_db.get_last_trading_date()
+        assert replica.call_count == 2
+
+        # решения загрузки принимаются по основной БД
+        await real_db.get_trading_dates(date(1999, 1, 1), date(1999, 1, 31))
+        assert replica.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_writers_do_not_deadlock(real_db):
+    trade_date = date(1999, 1, 8)
+    records = [make_record(f'TSD{i:04d}X', trade_date) for i in range(2000)]
+    try:
+        # одни и те же инструменты в противоположном порядке
+        results = await asyncio.gather(real_db.save_records(records, on_conflict='update'),
+                                       real_db.save_records(records[::-1], on_conflict='update'))
+    finally:
+        async with real_db.async_session() as session:
+            await session.execute(delete(real_db.TRADING_TABLE)
+                                  .where(real_db.TRADING_TABLE.c.date == trade_date))
+            if real_db.DB_NORMALIZED:
+                instruments = real_db.SpimexInstrument.__table__
+                await session.execute(delete(instruments).where(instruments.c.exchange_product_id.like('TSD%')))
+                real_db._known_instruments.difference_update(r['exchange_product_id'] for r in records)
+            await session.commit()
+        await real_db.refresh_daily_aggregates({trade_date})
+
+    assert sum(r['inserted'] for r in results) == len(records)
+
+
+@pytest.mark.asyncio
+async def test_wait_for_replica(real_db, monkeypatch):
+    assert await real_db.wait_for_replica()
+
+    # «реплика» на той же БД: не standby, значит сразу догнала
+    replica = create_async_engine(real_db.db_url)
+    monkeypatch.setattr(real_db, 'read_engine', replica)
+    try:
+        assert await real_db.wait_for_replica(timeout=1)
+    finally:
+        await replica.dispose()
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not db.DB_NORMALIZED, reason="таблицы созданы в широкой схеме (DB_NORMALIZED=0)")
+async def test_normalized_backfills_instruments_from_wide_table(real_db):
+    trade_date = date(1999, 1, 11)
+    table = real_db.TRADING_TABLE.name
+    instruments = real_db.SpimexInstrument.__table__
+    wide_columns = ", ".join(f"ADD COLUMN {col} VARCHAR" for col in real_db.INSTRUMENT_COLUMNS)
+    await real_db.ensure_partitions([trade_date])
+    async with real_db.engine.begin() as conn:
+        # таблица торгов, оставшаяся от широкой схемы: без внешнего ключа и со столбцами инструмента
+        await conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_exchange_product_id_fkey"))
+        await conn.execute(text(f"ALTER TABLE {table} {wide_columns}"))
+        await conn.execute(text(
+            f"INSERT INTO {table} (exchange_product_id, exchange_product_name, oil_id, delivery_basis_id, "
+            f"delivery_basis_name, delivery_type_id, volume, total, count, date) "
+            f"VALUES ('TSW1ABC', 'Старая строка', 'TSW1', 'ABC', 'База', 'C', 1, 100, 1, :day)"
+        ), {"day": trade_date})
+    try:
+        await real_db.create_tables()
+        rows = await real_db.get_dynamics(trade_date, trade_date)
+    finally:
+        async with real_db.engine.begin() as conn:
+            await conn.execute(delete(real_db.TRADING_TABLE).where(real_db.TRADING_TABLE.c.date == trade_date))
+            await conn.execute(delete(instruments).where(instruments.c.exchange_product_id == 'TSW1ABC'))
+            await conn.execute(text(f"ALTER TABLE {table} "
+                                    + ", ".join(f"DROP COLUMN {col}" for col in real_db.INSTRUMENT_COLUMNS)))
+            await conn.execute(text(
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_exchange_product_id_fkey FOREIGN KEY "
+                f"(exchange_product_id) REFERENCES {instruments.name} (exchange_product_id)"
+            ))
+            await real_db._refresh_daily_aggregates(conn, [trade_date])
 
+    assert [(r.exchange_product_id, r.exchange_product_name) for r in rows] == [('TSW1ABC', 'Старая строка')]
@@ -0,0 +1,151 @@
+import time
+from datetime import date, timedelta
+from unittest.mock import patch
+
+import orjson
+
+import fakeredis
+import pytest
+
+import api_cache
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis()
+
+
+async def keys(redis):
+    return {k.decode()[len(api_cache.PREFIX):] for k in await redis.keys(api_cache.PREFIX + "*")
+            if b":idx:" not in k}
+
+
+@pytest.mark.asyncio
+async def test_invalidate_only_affected_keys(redis):
+    await api_cache.store(redis, "last_results", b"[]")
+    await api_cache.store(redis, "dynamics:july", b"[]", (date(2025, 7, 1), date(2025, 7, 31)))
+    await api_cache.store(redis, "dynamics:june", b"[]", (date(2025, 6, 1), date(2025, 6, 30)))
+    await api_cache.store(redis, "dynamics:july-tail", b"[]", (date(2025, 7, 20), date(2025, 7, 31)))
+    await api_cache.store(redis, "results:day", b"[]", (date(2025, 7, 10), date(2025, 7, 10)))
+
+    removed = await api_cache.invalidate_dates(redis, [date(2025, 7, 10)])
+
+    # сбрасываются последние данные и периоды, содержащие 10.07; июнь и хвост июля остаются
+    assert removed == 3
+    assert await keys(redis) == {"dynamics:june", "dynamics:july-tail"}
+    assert await redis.get(api_cache.DATA_VERSION_KEY) == b"1"
+    assert int(await redis.get(api_cache.DATA_CHANGED_AT_KEY)) > 0
+    # индекс чистится вместе с ключами
+    assert await redis.smembers(api_cache.LATEST_INDEX) == set()
+    assert await redis.zcard(api_cache.RANGE_INDEX) == 2
+
+
+@pytest.mark.asyncio
+async def test_historical_ranges_have_long_ttl(redis):
+    yesterday = date.today() - timedelta(days=1)
+    await api_cache.store(redis, "old", b"[]", (date(2025, 1, 1), date(2025, 1, 31)))
+    await api_cache.store(redis, "current", b"[]", (yesterday, date.today()))
+    await api_cache.store(redis, "latest", b"[]")
+
+    assert api_cache.CACHE_TTL < await redis.ttl(api_cache.redis_key("old")) <= api_cache.CACHE_PAST_TTL
+    assert 0 < await redis.ttl(api_cache.redis_key("current")) <= api_cache.CACHE_TTL
+    assert 0 < await redis.ttl(api_cache.redis_key("latest")) <= api_cache.CACHE_TTL
+
+
+@pytest.mark.asyncio
+async def test_store_skips_value_computed_before_ingest(redis):
+    version = await api_cache.read_data_version(redis)
+    assert await api_cache.store(redis, "fresh", b"[]", None, version)
+
+    await api_cache.invalidate_dates(redis, [date(2025, 7, 10)])
+    # значение начали считать до загрузки — оно устарело
+    assert not await api_cache.store(redis, "stale", b"[]", (date(2025, 1, 1), date(2025, 1, 31)), version)
+    assert "stale" not in await keys(redis)
+    assert await redis.zcard(api_cache.RANGE_INDEX) == 0
+
+
+@pytest.mark.asyncio
+async def test_store_racing_invalidation_does_not_survive(redis):
+    version = await api_cache.read_data_version(redis)
+    await api_cache.store(redis, "last_results", b"OLD", None, version)
+    read_index = redis.smembers
+    raced = []
+
+    async def smembers_with_racing_store(key):
+        # значение, посчитанное до загрузки, пишется прямо во время инвалидации
+        raced.append(await api_cache.store(redis, "last_dates", b"OLD", None, version))
+        return await read_index(key)
+
+    redis.smembers = smembers_with_racing_store
+    await api_cache.invalidate_dates(redis, [date(2025, 7, 10)])
+
+    assert raced == [False]
+    assert await keys(redis) == set()
+    assert await redis.get(api_cache.DATA_VERSION_KEY) == b"1"
+
+
+@pytest.mark.asyncio
+async def test_range_index_is_capped(redis):
+    with patch("api_cache.CACHE_MAX_RANGE_KEYS", 2):
+        for day in (1, 2, 3):
+            await api_cache.store(redis, f"day{day}", b"[]", (date(2025, 1, day), date(2025, 1, day)))
+
+    # вытесняется период с самым ранним концом вместе с ключом
+    assert await keys(redis) == {"day2", "day3"}
+    assert await redis.zcard(api_cache.RANGE_INDEX) == 2
+
+
+@pytest.mark.asyncio
+async def test_publish_data_changed_survives_redis_errors():
+    class BrokenRedis:
+        async def smembers(self, key):
+            raise ConnectionError("redis down")
+
+    assert await api_cache.publish_data_changed([date(2025, 7, 1)], redis=BrokenRedis()) is None
+    assert await api_cache.publish_data_changed([], redis=fakeredis.FakeAsyncRedis()) == 0
+
+
+def wide_body(rows=5000):
+    """Тело вида /last_results: rows записей с полями TradingResult"""
+    return orjson.dumps([{"id": i, "exchange_product_id": f"A{i % 300:03d}NVY060F",
+                          "exchange_product_name": "Бензин (АИ-92-К5), ст. Новоярославская (ст. отправления)",
+                          "oil_id": "A100", "delivery_basis_id": "NVY", "delivery_basis_name": "ст. Новоярославская",
+                          "delivery_type_id": "F", "volume": 60.0 + i, "total": 3_851_580.0 + i, "count": i % 7,
+                          "date": "2025-07-01"} for i in range(rows)])
+
+
+@pytest.mark.parametrize("codec", ["zstd", "zlib"])
+def test_compressed_values_roundtrip(codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    body = wide_body()
+
+    with patch("api_cache.CACHE_CODEC", codec):
+        started = time.perf_counter()
+        encoded = api_cache.encode_value(body)
+        encode_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        assert api_cache.decode_value(encoded) == body
+        decode_ms = (time.perf_counter() - started) * 1000
+
+    print(f"{codec}: {len(body)} -> {len(encoded)} байт, сжатие {encode_ms:.1f} мс, распаковка {decode_ms:.1f} мс")
+    assert len(encoded) < len(body) / 5
+
+
+def test_small_and_legacy_values_are_stored_as_is():
+    small = b'[{"id":1}]'
+    assert api_cache.encode_value(small) == small
+    # записи до сжатия (JSON, страница с курсором) читаются без изменений
+    for raw in (wide_body(10), b"\0cursor\0[]", b"PAR1..."):
+        assert api_cache.decode_value(raw) == raw
+    with patch("api_cache.CACHE_CODEC", "none"):
+        assert api_cache.encode_value(wide_body()) == wide_body()
+
+
+@pytest.mark.asyncio
+async def test_store_keeps_compressed_value(redis):
+    body = wide_body()
+    await api_cache.store(redis, "last_results", body)
+
+    raw = await redis.get(api_cache.redis_key("last_results"))
+    assert len(raw) < len(body) and api_cache.decode_value(raw) == body
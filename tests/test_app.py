@@ -1,16 +1,30 @@
+import asyncio
+import io
+import json
+import time
 from unittest.mock import patch, AsyncMock, MagicMock
 from datetime import date
+from decimal import Decimal
+
+import fakeredis
+import httpx
+import pytest
 from fastapi.testclient import TestClient
 
+import app as app_module
 from app import app
+from api_cache import publish_data_changed, redis_key
 
 client = TestClient(app)
+# настоящие функции кэша (в остальных тестах они подменяются в conftest)
+real_get_cache = app_module.get_cache
+real_set_cache = app_module.set_cache
+
+
+def as_rows(items):
+    """Словари-фикстуры в кортежи колонок, как их отдают get_* с as_rows=True"""
+    return [tuple(item[field] for field in app_module.TRADING_RESULT_FIELDS) for item in items]
 
-#TODO seconds_until_next_invalidation
-#TODO invalidate_cache_if_needed
-#TODO get_cache
-#TODO set_cache
-#TODO model_to_serializable
 #TODO cache_invalidation_dep
 
 # ---------- Endpoints ----------
@@ -18,8 +32,7 @@ def test_get_last_trading_results_status_and_structure(mock_trading_results):
     """Тест проверки статус кода и структуры данных с моками"""
 
     with patch('app.get_last_trading_date', new=AsyncMock(return_value="2025-07-01")), \
-            patch('app.get_trading_results', new=AsyncMock(return_value=mock_trading_results)), \
-            patch('app.model_to_serializable', side_effect=lambda x: x):
+            patch('app.get_trading_results', new=AsyncMock(return_value=as_rows(mock_trading_results))):
         response = client.get("/last_results")
 
         # Проверяем статус код
@@ -52,7 +65,7 @@ def test_get_last_trading_results_status_and_structure(mock_trading_results):
 def test_get_last_trading_results_cached(mock_trading_results):
     """Тест получения данных из кэша"""
 
-    with patch('app.get_cache', return_value=mock_trading_results), \
+    with patch('app.get_cache', return_value=json.dumps(mock_trading_results).encode()), \
             patch('app.get_last_trading_date', new=AsyncMock()), \
             patch('app.get_trading_results', new=AsyncMock()):
         response = client.get("/last_results")
@@ -75,8 +88,7 @@ def test_get_last_trading_results_no_data():
 def test_get_dynamics_status_and_structure(mock_trading_results):
     """Тест проверки статус кода и структуры данных для эндпоинта dynamics"""
 
-    with patch('app.get_dynamics', new=AsyncMock(return_value=mock_trading_results)), \
-            patch('app.model_to_serializable', side_effect=lambda x: x):
+    with patch('app.get_dynamics', new=AsyncMock(return_value=as_rows(mock_trading_results))):
         response = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-03")
 
         # Проверяем статус код
@@ -107,8 +119,7 @@ def test_get_dynamics_status_and_structure(mock_trading_results):
 def test_get_dynamics_with_filters():
     """Тест с опциональными фильтрами"""
 
-    with patch('app.get_dynamics', new=AsyncMock(return_value=[])), \
-            patch('app.model_to_serializable', side_effect=lambda x: x):
+    with patch('app.get_dynamics', new=AsyncMock(return_value=[])):
         response = client.get(
             "/dynamics?start_date=2025-07-01&end_date=2025-07-03"
             "&oil_id=test_oil&delivery_type_id=test_type&delivery_basis_id=test_basis&limit=100"
@@ -131,7 +142,7 @@ def test_get_dynamics_invalid_dates():
 def test_get_dynamics_cached(mock_trading_results):
     """Тест получения dynamics из кэша"""
 
-    with patch('app.get_cache', return_value=mock_trading_results), \
+    with patch('app.get_cache', return_value=json.dumps(mock_trading_results).encode()), \
             patch('app.get_dynamics', new=AsyncMock()):
         response = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-03")
 
@@ -143,10 +154,10 @@ def test_get_last_trading_dates(mock_cached_dates):
     """Тест для эндпоинта /last_dates"""
 
     with patch('app.get_cache', return_value=None), \
-            patch('app.async_session') as mock_async_session:
+            patch('app.read_session') as mock_read_session:
         # Мокируем асинхронную сессию
         mock_session = AsyncMock()
-        mock_async_session.return_value.__aenter__.return_value = mock_session
+        mock_read_session.return_value.__aenter__.return_value = mock_session
 
         # Мокируем результат запроса
         mock_result = MagicMock()
@@ -171,8 +182,8 @@ def test_get_last_trading_dates(mock_cached_dates):
 def test_get_last_trading_dates_cached(mock_cached_dates):
     """Тест для эндпоинта /last_dates с кэшированными данными"""
 
-    with patch('app.get_cache', return_value=mock_cached_dates), \
-            patch('app.async_session'):
+    with patch('app.get_cache', return_value=json.dumps(mock_cached_dates).encode()), \
+            patch('app.read_session'):
         response = client.get("/last_dates?limit=3")
 
         assert response.status_code == 200
@@ -184,9 +195,9 @@ def test_get_last_trading_dates_default_limit():
     """Тест для эндпоинта /last_dates с дефолтным лимитом"""
 
     with patch('app.get_cache', return_value=None), \
-            patch('app.async_session') as mock_async_session:
+            patch('app.read_session') as mock_read_session:
         mock_session = AsyncMock()
-        mock_async_session.return_value.__aenter__.return_value = mock_session
+        mock_read_session.return_value.__aenter__.return_value = mock_session
 
         mock_result = MagicMock()
         mock_result.all.return_value = [(date(2025, 7, 1),)]
@@ -204,8 +215,7 @@ def test_api_get_trading_results(mock_ural_trading_result):
 
     mock_results = [mock_ural_trading_result]
 
-    with patch('app.get_trading_results', new=AsyncMock(return_value=mock_results)), \
-            patch('app.model_to_serializable', side_effect=lambda x: x):
+    with patch('app.get_trading_results', new=AsyncMock(return_value=as_rows(mock_results))):
         response = client.get("/results?oil_id=URAL&limit=100")
 
         # Проверяем статус код
@@ -224,8 +234,7 @@ def test_api_get_trading_results(mock_ural_trading_result):
 def test_api_get_trading_results_with_all_filters():
     """Тест для эндпоинта /results со всеми фильтрами"""
 
-    with patch('app.get_trading_results', new=AsyncMock(return_value=[])), \
-            patch('app.model_to_serializable', side_effect=lambda x: x):
+    with patch('app.get_trading_results', new=AsyncMock(return_value=[])):
         response = client.get(
             "/results?oil_id=URAL&delivery_type_id=T&delivery_basis_id=BAS&date_value=2025-07-01&limit=50"
         )
@@ -240,7 +249,7 @@ def test_api_get_trading_results_cached(mock_ural_trading_result):
 
     cached_data = [mock_ural_trading_result]
 
-    with patch('app.get_cache', return_value=cached_data), \
+    with patch('app.get_cache', return_value=json.dumps(cached_data).encode()), \
             patch('app.get_trading_results', new=AsyncMock()) as mock_get_trading:
         response = client.get("/results?oil_id=URAL&limit=100")
 
@@ -253,13 +262,581 @@ def test_api_get_trading_results_cached(mock_ural_trading_result):
 def test_api_get_trading_results_default_limit():
     """Тест для эндпоинта /results с дефолтным лимитом"""
 
-    with patch('app.get_trading_results', new=AsyncMock(return_value=[])) as mock_get_trading, \
-            patch('app.model_to_serializable', side_effect=lambda x: x):
+    with patch('app.get_trading_results', new=AsyncMock(return_value=[])) as mock_get_trading:
         response = client.get("/results")
 
         assert response.status_code == 200
         # Проверяем, что был вызван с лимитом 100 (по умолчанию)
         mock_get_trading.assert_called_once_with(
             limit=100, oil_id=None, delivery_type_id=None,
-            delivery_basis_id=None, date_value=None
+            delivery_basis_id=None, date_value=None, as_rows=True, after=None
         )
+
+
+def test_get_daily_dynamics():
+    """Тест для эндпоинта /dynamics/daily"""
+
+    rows = [{"date": date(2025, 7, 1), "oil_id": "A100", "delivery_type_id": "F", "volume": Decimal("60"),
+             "total": Decimal("3000000"), "count": 2, "vwap": Decimal("50000")}]
+
+    with patch('app.get_daily_aggregates', new=AsyncMock(return_value=rows)) as mock_aggregates:
+        response = client.get("/dynamics/daily?start_date=2025-07-01&end_date=2025-07-03"
+                              "&group_by=oil_id&group_by=delivery_type_id")
+
+        assert response.status_code == 200
+        assert response.json() == [{"date": "2025-07-01", "oil_id": "A100", "delivery_basis_id": None,
+                                    "delivery_type_id": "F", "volume": 60.0, "total": 3000000.0,
+                                    "count": 2, "vwap": 50000.0}]
+        assert mock_aggregates.await_args.kwargs["group_by"] == ["delivery_type_id", "oil_id"]
+
+
+def test_get_daily_dynamics_invalid_group_by():
+    """Тест для /dynamics/daily с неизвестным измерением группировки"""
+
+    response = client.get("/dynamics/daily?start_date=2025-07-01&end_date=2025-07-03&group_by=name")
+
+    assert response.status_code == 422
+
+
+# ---------- Redis cache ----------
+class SlowRedis:
+    """Асинхронный Redis-заглушка с задержкой на каждую операцию"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.data = {}
+
+    async def get(self, key):
+        await asyncio.sleep(self.delay)
+        return self.data.get(key)
+
+    async def set(self, key, value, nx=False, px=None):
+        await asyncio.sleep(self.delay)
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def delete(self, key):
+        await asyncio.sleep(self.delay)
+        self.data.pop(key, None)
+
+    async def exists(self, key):
+        await asyncio.sleep(self.delay)
+        return int(key in self.data)
+
+
+@pytest.mark.asyncio
+async def test_cache_roundtrip(mock_trading_results):
+    body = json.dumps(mock_trading_results).encode()
+    with patch('app.redis', fakeredis.FakeAsyncRedis()) as fake_redis:
+        await real_set_cache("key", body)
+        app_module.local_cache.clear()
+        # промах локального кэша читается из Redis
+        assert await real_get_cache("key") == body
+        assert await fake_redis.get(redis_key("key")) == body
+        assert await real_get_cache("missing") is None
+
+
+@pytest.mark.asyncio
+async def test_cache_does_not_block_event_loop(mock_trading_results):
+    """Медленный Redis не должен выстраивать параллельные запросы в очередь"""
+
+    delay = 0.05
+    slow_redis = SlowRedis(delay)
+    slow_redis.data[redis_key("last_results")] = json.dumps(mock_trading_results).encode()
+
+    with patch('app.redis', slow_redis), patch('app.get_cache', new=real_get_cache):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as ac:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(ac.get("/last_results") for _ in range(20)))
+            elapsed = time.perf_counter() - started
+
+    assert all(r.status_code == 200 for r in responses)
+    # при блокирующем клиенте 20 запросов заняли бы не меньше 20 * delay
+    print(f"20 параллельных запросов при задержке Redis {delay * 1000:.0f} мс: {elapsed * 1000:.0f} мс")
+    assert elapsed < 20 * delay / 2
+
+
+def test_local_cache_evicts_by_bytes():
+    cache = app_module.LocalCache(max_bytes=10)
+    cache.set("a", b"12345", ttl=60)
+    cache.set("b", b"1234", ttl=60)
+    assert cache.get("a") == b"12345"  # "a" становится самым свежим
+
+    cache.set("c", b"123", ttl=60)  # 12 байт > 10, вытесняется "b"
+    cache.set("huge", b"x" * 11, ttl=60)  # больше всего кэша — не сохраняется
+
+    assert cache.get("b") is None
+    assert cache.get("huge") is None
+    assert cache.get("c") == b"123"
+    assert cache.info()["bytes"] == 8
+    assert cache.stats == {"hits": 2, "misses": 2, "evictions": 1, "expired": 0}
+
+
+def test_local_cache_ttl():
+    cache = app_module.LocalCache(max_bytes=100)
+    with patch('app.monotonic', return_value=1000.0):
+        cache.set("key", b"value", ttl=10)
+    with patch('app.monotonic', return_value=1009.0):
+        assert cache.get("key") == b"value"
+    with patch('app.monotonic', return_value=1010.0):
+        assert cache.get("key") is None
+    assert cache.stats["expired"] == 1
+    assert cache.info()["bytes"] == 0
+
+
+@pytest.mark.asyncio
+async def test_get_cache_served_from_local_cache(mock_trading_results):
+    body = json.dumps(mock_trading_results).encode()
+    slow_redis = SlowRedis()
+    with patch('app.redis', slow_redis):
+        await real_set_cache("key", body)
+        # из Redis ключ пропал, но локальный кэш ещё отвечает
+        slow_redis.data.clear()
+        assert await real_get_cache("key") == body
+
+
+def test_cache_stats_endpoint():
+    response = client.get("/cache/stats")
+
+    assert response.status_code == 200
+    assert set(response.json()) >= {"hits", "misses", "evictions", "bytes"}
+
+
+def test_cache_hit_skips_response_validation():
+    """Попадание в кэш отдаётся как есть, без валидации по response_model"""
+
+    body = b'[{"id":1,"raw":"as-is"}]'
+    with patch('app.get_cache', return_value=body):
+        response = client.get("/last_results")
+
+        assert response.status_code == 200
+        assert response.content == body
+
+
+def test_results_body_from_rows(mock_trading_result):
+    """Ответ на промахе строится из кортежей колонок через orjson, в порядке полей модели"""
+
+    row = as_rows([{**mock_trading_result, "volume": 1000.5, "date": date(2025, 7, 1)}])[0]
+    with patch('app.get_trading_results', new=AsyncMock(return_value=[row])), \
+            patch('app.set_cache') as mock_set_cache:
+        response = client.get("/results")
+
+        data = response.json()
+        assert list(data[0]) == list(app_module.TRADING_RESULT_FIELDS)
+        assert data[0]["volume"] == 1000.5 and data[0]["date"] == "2025-07-01"
+        # в кэш кладутся ровно те байты, что ушли клиенту
+        assert mock_set_cache.await_args.args[1] == response.content
+
+
+def test_dynamics_next_cursor(mock_trading_result):
+    """Заполненная страница отдаёт курсор, переданный курсор превращается в (date, id)"""
+
+    rows = as_rows([{**mock_trading_result, "id": i, "date": date(2025, 7, 1)} for i in (1, 2)])
+    with patch('app.get_dynamics', new=AsyncMock(return_value=rows)) as mock_get_dynamics:
+        first = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-31&limit=2")
+        token = first.headers[app_module.NEXT_CURSOR_HEADER]
+        client.get(f"/dynamics?start_date=2025-07-01&end_date=2025-07-31&limit=2&cursor={token}")
+
+        assert app_module.decode_cursor(token) == (date(2025, 7, 1), 2)
+        assert mock_get_dynamics.await_args_list[0].kwargs["after"] is None
+        assert mock_get_dynamics.await_args_list[1].kwargs["after"] == (date(2025, 7, 1), 2)
+
+    # неполная страница — последняя
+    with patch('app.get_dynamics', new=AsyncMock(return_value=rows[:1])):
+        last = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-31&limit=2")
+        assert app_module.NEXT_CURSOR_HEADER not in last.headers
+
+
+def test_results_invalid_cursor():
+    """Битый курсор — 400"""
+
+    with patch('app.get_trading_results', new=AsyncMock()) as mock_get_trading:
+        response = client.get("/results?cursor=not-a-cursor")
+
+        assert response.status_code == 400
+        mock_get_trading.assert_not_called()
+
+
+def test_cached_page_keeps_cursor():
+    """Курсор страницы хранится вместе с телом и отдаётся на попадании в кэш"""
+
+    token = app_module.encode_cursor(date(2025, 7, 1), 7)
+    body = b'[{"id":7}]'
+    with patch('app.get_cache', return_value=app_module.pack_page(body, token)):
+        response = client.get("/results?limit=1")
+
+        assert response.content == body
+        assert response.headers[app_module.NEXT_CURSOR_HEADER] == token
+    assert app_module.unpack_page(body) == (body, None)
+
+
+def fake_stream(batches):
+    """Подмена stream_dynamics: асинхронный генератор заранее заданных пачек"""
+    async def stream(**kwargs):
+        for rows in batches:
+            yield rows
+    return stream
+
+
+def test_export_dynamics_ndjson(mock_trading_result):
+    """Выгрузка NDJSON: по строке JSON на сделку, пачки склеиваются"""
+
+    rows = as_rows([{**mock_trading_result, "id": i, "date": date(2025, 7, 1)} for i in (1, 2, 3)])
+    with patch('app.stream_dynamics', new=fake_stream([rows[:2], rows[2:]])):
+        response = client.get("/dynamics/export?start_date=2025-07-01&end_date=2025-07-31")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [item["id"] for item in lines] == [1, 2, 3]
+        assert lines[0]["date"] == "2025-07-01"
+
+
+def test_export_dynamics_csv(mock_trading_result):
+    """Выгрузка CSV: заголовок из полей модели и строка на сделку"""
+
+    rows = as_rows([{**mock_trading_result, "date": date(2025, 7, 1)}])
+    with patch('app.stream_dynamics', new=fake_stream([rows])):
+        response = client.get("/dynamics/export?start_date=2025-07-01&end_date=2025-07-31&format=csv")
+
+        assert response.headers["content-type"].startswith("text/csv")
+        header, line = response.text.splitlines()
+        assert header.split(",") == list(app_module.TRADING_RESULT_FIELDS)
+        assert line.endswith(",2025-07-01") and "RU000A0JX0J2" in line
+
+
+def test_export_dynamics_invalid_dates():
+    """Перепутанные даты — 400 до начала выгрузки"""
+
+    response = client.get("/dynamics/export?start_date=2025-07-31&end_date=2025-07-01")
+    assert response.status_code == 400
+
+
+def test_dynamics_arrow_format(mock_trading_result):
+    """format=arrow — поток Arrow IPC с колонками модели, читается сразу в таблицу"""
+    pa = pytest.importorskip("pyarrow")
+
+    rows = as_rows([{**mock_trading_result, "id": i, "volume": 10.5, "date": date(2025, 7, 1)} for i in (1, 2)])
+    with patch('app.get_dynamics', new=AsyncMock(return_value=rows)), \
+            patch('app.set_cache') as mock_set_cache:
+        response = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-31&format=arrow")
+
+        assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+        table = pa.ipc.open_stream(response.content).read_all()
+        assert table.column_names == list(app_module.TRADING_RESULT_FIELDS)
+        assert table.column("id").to_pylist() == [1, 2]
+        assert table.column("date").to_pylist() == [date(2025, 7, 1)] * 2
+        # колоночные ответы кэшируются отдельно от JSON
+        assert mock_set_cache.await_args.args[0].endswith(":arrow")
+
+
+def test_results_parquet_by_accept():
+    """Формат выбирается по Accept; пустая выборка — пустая таблица со схемой"""
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    with patch('app.get_trading_results', new=AsyncMock(return_value=[])):
+        response = client.get("/results", headers={"Accept": "application/vnd.apache.parquet"})
+
+        assert response.headers["content-type"] == "application/vnd.apache.parquet"
+        table = pq.read_table(io.BytesIO(response.content))
+        assert table.num_rows == 0 and table.column_names == list(app_module.TRADING_RESULT_FIELDS)
+
+
+def test_columnar_format_without_pyarrow():
+    """Без pyarrow колоночные форматы — 406, JSON работает как раньше"""
+
+    with patch('app.pa', None), patch('app.get_trading_results', new=AsyncMock(return_value=[])):
+        assert client.get("/last_results?format=parquet").status_code == 406
+        assert client.get("/results").status_code == 200
+
+
+async def slow(value, delay=0.05):
+    await asyncio.sleep(delay)
+    return value
+
+
+@pytest.mark.asyncio
+async def test_identical_misses_run_one_query(mock_trading_results):
+    """Одновременные одинаковые промахи ждут один запрос к БД"""
+
+    async def slow_results(**kwargs):
+        return await slow(as_rows(mock_trading_results))
+
+    mock_get_trading = AsyncMock(side_effect=slow_results)
+    with patch('app.get_last_trading_date', new=AsyncMock(return_value=date(2025, 7, 1))), \
+            patch('app.get_trading_results', new=mock_get_trading), \
+            patch('app.set_cache') as mock_set_cache:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as ac:
+            responses = await asyncio.gather(*(ac.get("/last_results") for _ in range(20)))
+
+    assert {r.status_code for r in responses} == {200}
+    assert len({r.content for r in responses}) == 1
+    assert mock_get_trading.await_count == 1
+    assert mock_set_cache.await_count == 1
+    assert app_module._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_errors_and_retries():
+    """Ошибка отдаётся всем ожидающим и не кэшируется: следующий промах считает заново"""
+
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("db down")
+
+    results = await asyncio.gather(*(app_module.single_flight("k", failing) for _ in range(5)),
+                                   return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results) and len(calls) == 1
+
+    assert await app_module.single_flight("k", lambda: slow(b"ok", 0)) == b"ok"
+
+
+@pytest.mark.asyncio
+async def test_single_flight_waits_for_other_worker():
+    """Ключ под блокировкой другого воркера: ждём его значение в кэше, а не идём в БД"""
+
+    fake_redis = SlowRedis()
+    fake_redis.data[redis_key("lock:k")] = b"1"
+    load = AsyncMock()
+
+    async def other_worker():
+        await asyncio.sleep(0.05)
+        fake_redis.data[redis_key("k")] = b"from-other-worker"
+
+    with patch('app.redis', fake_redis), patch('app.get_cache', new=real_get_cache), \
+            patch('app.SINGLE_FLIGHT_POLL', 0.01):
+        body, _ = await asyncio.gather(app_module.single_flight("k", load), other_worker())
+
+    assert body == b"from-other-worker"
+    load.assert_not_called()
+    # чужую блокировку не снимаем
+    assert fake_redis.data[redis_key("lock:k")] == b"1"
+
+
+@pytest.mark.asyncio
+async def test_single_flight_takes_over_failed_fill():
+    """Другой воркер снял блокировку, ничего не сохранив: не ждём SINGLE_FLIGHT_WAIT, а считаем сами"""
+
+    fake_redis = fakeredis.FakeAsyncRedis()
+    await fake_redis.set(redis_key("lock:k"), "other")
+
+    async def other_worker_fails():
+        await asyncio.sleep(0.05)
+        await fake_redis.delete(redis_key("lock:k"))
+
+    with patch('app.redis', fake_redis), patch('app.get_cache', new=real_get_cache), \
+            patch('app.SINGLE_FLIGHT_POLL', 0.01), patch('app.SINGLE_FLIGHT_WAIT', 3):
+        started = time.perf_counter()
+        body, _ = await asyncio.gather(app_module.single_flight("k", lambda: slow(b"ours", 0)),
+                                       other_worker_fails())
+        elapsed = time.perf_counter() - started
+
+    assert body == b"ours"
+    assert elapsed < 1
+    # свою блокировку после вычисления сняли
+    assert not await fake_redis.exists(redis_key("lock:k"))
+
+
+@pytest.mark.asyncio
+async def test_fill_started_before_ingest_is_not_cached():
+    """Загрузка прошла, пока считалось значение: старое тело отдаём, но не кэшируем"""
+
+    fake_redis = fakeredis.FakeAsyncRedis()
+
+    async def load_during_ingest():
+        await publish_data_changed([date(2025, 1, 10)], redis=fake_redis)
+        return b"pre-ingest"
+
+    with patch('app.redis', fake_redis), patch('app.set_cache', new=real_set_cache):
+        body = await app_module.single_flight("k", load_during_ingest, (date(2025, 1, 1), date(2025, 1, 31)))
+
+    assert body == b"pre-ingest"
+    assert not await fake_redis.exists(redis_key("k"))
+    assert app_module.local_cache.get("k") is None
+
+
+@pytest.mark.asyncio
+async def test_fill_lock_released_only_by_owner():
+    """Истёкшую блокировку уже взял другой воркер — её не снимаем"""
+
+    fake_redis = fakeredis.FakeAsyncRedis()
+    with patch('app.redis', fake_redis):
+        token = await app_module._acquire_fill_lock("k")
+        assert token and await app_module._acquire_fill_lock("k") is None
+
+        await fake_redis.set(redis_key("lock:k"), "other")
+        await app_module._release_fill_lock("k", token)
+        assert await fake_redis.get(redis_key("lock:k")) == b"other"
+
+        await fake_redis.set(redis_key("lock:k"), token)
+        await app_module._release_fill_lock("k", token)
+        assert not await fake_redis.exists(redis_key("lock:k"))
+
+
+@pytest.mark.asyncio
+async def test_local_cache_follows_data_version():
+    """После события загрузки (новая версия данных в Redis) воркер сбрасывает локальный кэш"""
+
+    fake_redis = fakeredis.FakeAsyncRedis()
+    with patch('app.redis', fake_redis), patch('app._version_checked_at', float("-inf")), \
+            patch('app.data_version', None), patch('app.CACHE_EVENT_POLL', 0):
+        await app_module.sync_local_cache()
+        app_module.local_cache.set("last_results", b"[]", ttl=60)
+
+        await app_module.sync_local_cache()
+        assert app_module.local_cache.get("last_results") == b"[]"
+
+        await fake_redis.incr(app_module.DATA_VERSION_KEY)
+        await app_module.sync_local_cache()
+        assert app_module.local_cache.get("last_results") is None
+
+
+def test_dynamics_cached_with_period_scope():
+    """Ключ /dynamics регистрируется с периодом запроса, /results без даты — как последние данные"""
+
+    with patch('app.get_dynamics', new=AsyncMock(return_value=[])), \
+            patch('app.get_trading_results', new=AsyncMock(return_value=[])), \
+            patch('app.set_cache') as mock_set_cache:
+        client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-31")
+        client.get("/results")
+        client.get("/results?date_value=2025-07-02")
+
+    scopes = [c.args[2] for c in mock_set_cache.await_args_list]
+    assert scopes == [(date(2025, 7, 1), date(2025, 7, 31)), None, (date(2025, 7, 2), date(2025, 7, 2))]
+
+
+@pytest.mark.asyncio
+async def test_access_stats_flushed_to_redis():
+    """Частота запросов копится в процессе и раз в CACHE_EVENT_POLL уходит в ZSET статистики"""
+
+    fake_redis = fakeredis.FakeAsyncRedis()
+    with patch('app.redis', fake_redis), patch('app._version_checked_at', float("-inf")), \
+            patch('app.CACHE_EVENT_POLL', 0), patch('app.get_trading_results', new=AsyncMock(return_value=[])):
+        app_module.access_stats.clear()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as ac:
+            await ac.get("/results?oil_id=URAL&limit=5")
+            # порядок и посторонние параметры не создают новых записей
+            await ac.get("/results?limit=5&oil_id=URAL&utm=1")
+            await ac.get("/results?oil_id=URAL&cursor=abc")
+            # запросы с ошибкой валидации не учитываются
+            await ac.get("/results?limit=abc")
+
+        await app_module.sync_local_cache()
+
+    assert await fake_redis.zscore(app_module.ACCESS_STATS_KEY, "/results?limit=5&oil_id=URAL") == 2
+    assert await fake_redis.zcard(app_module.ACCESS_STATS_KEY) == 1
+    assert not app_module.access_stats
+
+
+@pytest.mark.asyncio
+async def test_access_stats_trimmed_to_top():
+    fake_redis = fakeredis.FakeAsyncRedis()
+    with patch('app.redis', fake_redis), patch('app.ACCESS_STATS_MAX', 2):
+        app_module.access_stats.update({"/results?oil_id=A": 3, "/results?oil_id=B": 1, "/results?oil_id=C": 2})
+        await app_module.flush_access_stats()
+
+    assert await fake_redis.zrange(app_module.ACCESS_STATS_KEY, 0, -1) == [b"/results?oil_id=C",
+                                                                           b"/results?oil_id=A"]
+
+
+@pytest.mark.asyncio
+async def test_cache_reads_compressed_and_plain_values():
+    """В Redis большое значение лежит сжатым, get_cache отдаёт готовое тело; старые несжатые записи тоже читаются"""
+
+    body = json.dumps([{"id": i, "oil_id": "A100"} for i in range(2000)]).encode()
+    with patch('app.redis', fakeredis.FakeAsyncRedis()) as fake_redis:
+        await real_set_cache("big", body)
+        await fake_redis.set(redis_key("legacy"), b'[{"id":1}]')
+        app_module.local_cache.clear()
+
+        assert len(await fake_redis.get(redis_key("big"))) < len(body)
+        assert await real_get_cache("big") == body
+        assert await real_get_cache("legacy") == b'[{"id":1}]'
+        # в локальном кэше — уже распакованное тело
+        assert app_module.local_cache.get("big") == body
+
+
+def test_etag_and_not_modified(mock_trading_results):
+    """ETag по версии данных; совпавший If-None-Match — 304 без обращения к кэшу и БД"""
+
+    with patch('app.data_version', b"7"), patch('app.data_changed_at', 1751371200), \
+            patch('app.get_last_trading_date', new=AsyncMock(return_value=date(2025, 7, 1))), \
+            patch('app.get_trading_results', new=AsyncMock(return_value=as_rows(mock_trading_results))):
+        first = client.get("/last_results")
+        etag = first.headers["etag"]
+        assert first.headers["cache-control"] == f"public, max-age={app_module.HTTP_MAX_AGE}"
+        assert first.headers["last-modified"] == "Tue, 01 Jul 2025 12:00:00 GMT"
+
+        with patch('app.get_cache') as mock_get_cache, patch('app.get_trading_results') as mock_get_trading:
+            second = client.get("/last_results", headers={"If-None-Match": etag})
+            assert second.status_code == 304 and second.content == b""
+            assert second.headers["etag"] == etag
+            mock_get_cache.assert_not_called()
+            mock_get_trading.assert_not_called()
+
+        # другой запрос или формат — другой ETag
+        assert client.get("/last_results?format=json").headers["etag"] != etag
+
+    # после загрузки версия меняется, старый ETag больше не совпадает
+    with patch('app.data_version', b"8"), \
+            patch('app.get_last_trading_date', new=AsyncMock(return_value=date(2025, 7, 2))), \
+            patch('app.get_trading_results', new=AsyncMock(return_value=[])):
+        third = client.get("/last_results", headers={"If-None-Match": etag})
+        assert third.status_code == 200 and third.headers["etag"] != etag
+
+
+def test_no_etag_without_data_version():
+    """Без Redis версия данных неизвестна — ответы без ETag, 304 не отдаётся"""
+
+    with patch('app.data_version', None), patch('app.get_trading_results', new=AsyncMock(return_value=[])):
+        response = client.get("/results", headers={"If-None-Match": "*"})
+        assert response.status_code == 200
+        assert "etag" not in response.headers
+
+
+def big_rows(mock_trading_result, count=500):
+    return as_rows([{**mock_trading_result, "id": i, "date": date(2025, 7, 1)} for i in range(count)])
+
+
+def test_large_response_compressed_once(mock_trading_result):
+    """Большое тело сжимается при сборке, в кэш кладётся сжатым и отдаётся с Content-Encoding"""
+
+    with patch('app.get_dynamics', new=AsyncMock(return_value=big_rows(mock_trading_result))), \
+            patch('app.HTTP_COMPRESSION', 'gzip'), patch('app.set_cache') as mock_set_cache:
+        response = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-31",
+                              headers={"Accept-Encoding": "gzip"})
+
+        assert response.headers["content-encoding"] == "gzip"
+        assert len(response.json()) == 500
+        cached = mock_set_cache.await_args.args[1]
+        assert cached.startswith(b"\x02g") and len(cached) < len(response.content) / 5
+
+    # попадание в кэш: клиенту с gzip — как есть, без gzip — распакованным
+    with patch('app.get_cache', return_value=cached):
+        compressed = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-31",
+                                headers={"Accept-Encoding": "gzip"})
+        plain = client.get("/dynamics?start_date=2025-07-01&end_date=2025-07-31",
+                           headers={"Accept-Encoding": "identity"})
+
+        assert compressed.headers["content-encoding"] == "gzip"
+        assert compressed.num_bytes_downloaded == len(cached) - 2
+        assert "content-encoding" not in plain.headers
+        assert plain.json() == compressed.json()
+
+
+def test_small_response_not_compressed(mock_trading_results):
+    with patch('app.get_trading_results', new=AsyncMock(return_value=as_rows(mock_trading_results))):
+        response = client.get("/results", headers={"Accept-Encoding": "gzip, br"})
+
+        assert "content-encoding" not in response.headers
+
+
+def test_accepted_encodings_respects_q_zero():
+    request = MagicMock(headers={"accept-encoding": "gzip;q=0, br;q=0.8, Deflate"})
+    assert app_module.accepted_encodings(request) == {"br", "deflate"}
@@ -3,7 +3,9 @@ import runpy
 
 import pytest
 import datetime
-from unittest.mock import AsyncMock, patch, mock_open, call
+from unittest.mock import AsyncMock, patch, mock_open
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 
 import main
@@ -113,12 +115,17 @@ async def test_main(monkeypatch):
     monkeypatch.setattr(main.datetime, "datetime", FixedDatetime)
 
     mock_create_tables = AsyncMock()
-    mock_download_files = AsyncMock()
-    mock_parse_to_db = AsyncMock()
+    mock_fetch_file = AsyncMock(side_effect=lambda session, url, downloader=None: (url.split("/")[-1], b""))
+    mock_parse_to_db = AsyncMock(return_value={'inserted': 1, 'updated': 0, 'skipped': 0})
+    mock_publish = AsyncMock()
 
     monkeypatch.setattr(main, "create_tables", mock_create_tables)
-    monkeypatch.setattr(main, "download_files", mock_download_files)
+    monkeypatch.setattr(main, "fetch_file", mock_fetch_file)
     monkeypatch.setattr(main, "parse_to_db", mock_parse_to_db)
+    monkeypatch.setattr(main, "publish_data_changed", mock_publish)
+    monkeypatch.setattr(main, "warm_up_cache", AsyncMock())
+    mock_wait = AsyncMock(return_value=True)
+    monkeypatch.setattr(main, "wait_for_replica", mock_wait)
 
     class DummySessionCM:
         async def __aenter__(self):
@@ -126,14 +133,7 @@ async def test_main(monkeypatch):
         async def __aexit__(self, exc_type, exc, tb):
             pass
 
-    monkeypatch.setattr(main.aiohttp, "ClientSession", lambda: DummySessionCM())
-
-    main.filenames.clear()
-    main.filenames.extend([
-        "oil_xls_20250701162000.xls",
-        "oil_xls_20250702162000.xls",
-        "oil_xls_20250703162000.xls",
-    ])
+    monkeypatch.setattr(main.aiohttp, "ClientSession", lambda **kwargs: DummySessionCM())
 
     await main.main()
 
@@ -145,16 +145,70 @@ async def test_main(monkeypatch):
         for d in expected_dates
     ]
 
-    calls = mock_download_files.await_args_list
+    calls = mock_fetch_file.await_args_list
     called_urls = [c.args[1] for c in calls]
     assert called_urls == expected_urls
     assert all(c.args[0] == "SESSION" for c in calls)
 
-    mock_parse_to_db.assert_has_awaits(
-        [call(name) for name in main.filenames],
-        any_order=True
+    parsed = [c.args[0] for c in mock_parse_to_db.await_args_list]
+    assert sorted(parsed) == [f"oil_xls_{d}162000.xls" for d in expected_dates]
+    # одно событие для кэша API со всеми изменившимися датами (после того как реплика догнала), затем прогрев
+    mock_wait.assert_awaited_once()
+    mock_publish.assert_awaited_once_with({datetime.date(2025, 7, d) for d in (1, 2, 3)})
+    main.warm_up_cache.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_main_publishes_when_replica_check_fails(monkeypatch):
+    class FixedDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls(2025, 7, 1, 10, 0, 0)
+
+    monkeypatch.setattr(main.datetime, "datetime", FixedDatetime)
+    monkeypatch.setattr(main, "SYNC_START_DATE", "20250701")
+    mock_publish = AsyncMock()
+    monkeypatch.setattr(main, "create_tables", AsyncMock())
+    monkeypatch.setattr(main, "fetch_file", AsyncMock(return_value=("oil_xls_20250701162000.xls", b"")))
+    monkeypatch.setattr(main, "parse_to_db", AsyncMock(return_value={'inserted': 1, 'updated': 0, 'skipped': 0}))
+    monkeypatch.setattr(main, "wait_for_replica", AsyncMock(side_effect=ConnectionError("replica down")))
+    monkeypatch.setattr(main, "publish_data_changed", mock_publish)
+    monkeypatch.setattr(main, "warm_up_cache", AsyncMock())
+    monkeypatch.setattr(main.aiohttp, "ClientSession", lambda **kwargs: AsyncMock())
+
+    await main.main()
+
+    # ошибка реплики не отменяет сброс кэша и прогрев
+    mock_publish.assert_awaited_once_with({datetime.date(2025, 7, 1)})
+    main.warm_up_cache.assert_awaited_once()
+
+
+# Разбор начинается сразу после загрузки файла, не дожидаясь остальных
+@pytest.mark.asyncio
+async def test_download_and_parse_overlap(monkeypatch):
+    first_parsed = asyncio.Event()
+
+    async def fake_download(session, url, downloader=None):
+        if url.endswith("2.xls"):
+            # вторая загрузка завершится только после разбора первого файла
+            await asyncio.wait_for(first_parsed.wait(), timeout=1)
+        return url.split("/")[-1], b""
+
+    async def fake_parse(filename, executor=None, write_semaphore=None, content=None):
+        if filename == "file1.xls":
+            first_parsed.set()
+
+    monkeypatch.setattr(main, "fetch_file", fake_download)
+    monkeypatch.setattr(main, "parse_to_db", fake_parse)
+
+    write_semaphore = asyncio.Semaphore(1)
+    await asyncio.gather(
+        main.download_and_parse("SESSION", "https://example.com/file1.xls", None, write_semaphore),
+        main.download_and_parse("SESSION", "https://example.com/file2.xls", None, write_semaphore),
     )
 
+    assert first_parsed.is_set()
+
 # Строка 64 файла main.py
 def test_entrypoint_runs_main(monkeypatch):
     called = {}
@@ -167,4 +221,298 @@ def test_entrypoint_runs_main(monkeypatch):
 
     runpy.run_module("main", run_name="__main__")
 
-    assert called["coro"].__name__ == "main"
\ No newline at end of file
+    assert called["coro"].__name__ == "main"
+
+# Загрузчик против локального stub-сервера
+@pytest.fixture
+async def stub_server():
+    """Локальный HTTP-сервер: handler задаётся в тесте"""
+    servers = []
+
+    async def _start(handler):
+        web_app = web.Application()
+        web_app.router.add_get("/{name}", handler)
+        server = TestServer(web_app)
+        await server.start_server()
+        servers.append(server)
+        return server
+
+    yield _start
+    for server in servers:
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_downloader_retries_server_errors(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    attempts = 0
+
+    async def handler(request):
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            return web.Response(status=503)
+        return web.Response(body=b"xls-content")
+
+    server = await stub_server(handler)
+    downloader = main.Downloader(retries=3, backoff=0.01)
+    async with downloader.session() as session:
+        filename = await download_files(session, str(server.make_url("/oil_xls_20250801162000.xls")), downloader)
+
+    assert filename == "oil_xls_20250801162000.xls"
+    assert (tmp_path / filename).read_bytes() == b"xls-content"
+    assert downloader.stats["retries"] == 2
+    assert downloader.stats["ok"] == 1
+
+
+@pytest.mark.asyncio
+async def test_downloader_gives_up_after_retries(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def handler(request):
+        return web.Response(status=500)
+
+    server = await stub_server(handler)
+    downloader = main.Downloader(retries=2, backoff=0.01)
+    async with downloader.session() as session:
+        filename = await download_files(session, str(server.make_url("/file.xls")), downloader)
+
+    assert filename is None
+    assert downloader.stats["errors"] == 1
+    assert downloader.stats["retries"] == 2
+
+
+@pytest.mark.asyncio
+async def test_downloader_retries_rate_limit(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    attempts = []
+
+    async def handler(request):
+        attempts.append(asyncio.get_running_loop().time())
+        if len(attempts) == 1:
+            return web.Response(status=429, headers={"Retry-After": "0.2"})
+        return web.Response(body=b"xls-content")
+
+    server = await stub_server(handler)
+    downloader = main.Downloader(retries=3, backoff=0.01)
+    async with downloader.session() as session:
+        filename = await download_files(session, str(server.make_url("/oil_xls_20250801162000.xls")), downloader)
+
+    assert filename == "oil_xls_20250801162000.xls"
+    # пауза взята из Retry-After, а не из backoff
+    assert attempts[1] - attempts[0] >= 0.2
+    assert downloader.stats["retries"] == 1
+    assert downloader.missing == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("status, missing", [(404, 1), (410, 1), (403, 0), (408, 0)])
+async def test_downloader_only_not_found_is_missing(stub_server, tmp_path, monkeypatch, status, missing):
+    monkeypatch.chdir(tmp_path)
+
+    async def handler(request):
+        return web.Response(status=status)
+
+    server = await stub_server(handler)
+    downloader = main.Downloader(retries=2, backoff=0.01)
+    async with downloader.session() as session:
+        await download_files(session, str(server.make_url("/file.xls")), downloader)
+
+    assert downloader.stats["missing"] == missing
+    assert downloader.stats["errors"] == 1 - missing
+    assert len(downloader.missing) == missing
+    assert downloader.stats["retries"] == 0
+
+
+def test_retry_after_seconds():
+    assert main.retry_after_seconds("3") == 3.0
+    assert main.retry_after_seconds(None) is None
+    assert main.retry_after_seconds("garbage") is None
+    assert main.retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+@pytest.mark.asyncio
+async def test_downloader_shared_concurrency_limit(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    active = 0
+    max_active = 0
+
+    async def handler(request):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.02)
+        active -= 1
+        return web.Response(body=b"data")
+
+    server = await stub_server(handler)
+    downloader = main.Downloader(concurrency=2)
+    async with downloader.session() as session:
+        await asyncio.gather(*(download_files(session, str(server.make_url(f"/file{i}.xls")), downloader)
+                               for i in range(10)))
+
+    assert max_active == 2
+    assert downloader.stats["ok"] == 10
+
+
+# Инкрементальная синхронизация: качаем только дни, которых нет в БД и в манифесте
+@pytest.mark.asyncio
+async def test_main_incremental(monkeypatch, tmp_path):
+    class FixedDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls(2025, 7, 5, 10, 0, 0)
+
+    monkeypatch.setattr(main.datetime, "datetime", FixedDatetime)
+    manifest = tmp_path / "manifest.json"
+    monkeypatch.setattr(main, "SYNC_MANIFEST", str(manifest))
+    main.save_manifest({datetime.date(2025, 7, 2)}, str(manifest))
+
+    downloaded = []
+
+    async def fake_download(session, url, downloader=None):
+        downloaded.append(url)
+        # 07-03 и сегодняшнего (07-05) бюллетеня нет
+        if "20250703" in url or "20250705" in url:
+            downloader.missing.append(url)
+            return None, None
+        return url.split("/")[-1], b""
+
+    monkeypatch.setattr(main, "create_tables", AsyncMock())
+    monkeypatch.setattr(main, "get_trading_dates", AsyncMock(return_value={datetime.date(2025, 7, 1)}))
+    monkeypatch.setattr(main, "fetch_file", fake_download)
+    monkeypatch.setattr(main, "parse_to_db", AsyncMock(return_value={'inserted': 1, 'updated': 0, 'skipped': 0}))
+    mock_publish = AsyncMock()
+    monkeypatch.setattr(main, "publish_data_changed", mock_publish)
+    monkeypatch.setattr(main, "warm_up_cache", AsyncMock())
+    monkeypatch.setattr(main.aiohttp, "ClientSession", lambda **kwargs: AsyncMock())
+
+    await main.main(mode="incremental")
+
+    assert sorted(downloaded) == [main.bulletin_url(datetime.date(2025, 7, d)) for d in (3, 4, 5)]
+    # в событии для кэша только реально загруженный день
+    mock_publish.assert_awaited_once_with({datetime.date(2025, 7, 4)})
+    # сегодняшний день в манифест не попадает
+    assert main.load_manifest(str(manifest)) == {
+        datetime.date(2025, 7, 2), datetime.date(2025, 7, 3)
+    }
+
+
+@pytest.mark.asyncio
+async def test_downloader_conditional_request(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    requests_headers = []
+
+    async def handler(request):
+        requests_headers.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=b"xls-content", headers={"ETag": '"v1"'})
+
+    server = await stub_server(handler)
+    url = str(server.make_url("/oil_xls_20250801162000.xls"))
+    downloader = main.Downloader(cache=main.DownloadCache(str(tmp_path / "cache.json")))
+    async with downloader.session() as session:
+        first = await download_files(session, url, downloader)
+        # файл ещё не загружен в БД: при 304 его всё равно нужно разобрать
+        not_ingested = await download_files(session, url, downloader)
+        downloader.cache.mark_ingested(url)
+        ingested = await download_files(session, url, downloader)
+
+    assert first == not_ingested == "oil_xls_20250801162000.xls"
+    assert ingested is None
+    assert "If-None-Match" not in requests_headers[0]
+    assert requests_headers[1]["If-None-Match"] == '"v1"'
+    assert downloader.stats["not_modified"] == 2
+    # кэш сохраняется на диск и читается при следующем запуске
+    await downloader.cache.flush()
+    assert main.DownloadCache(str(tmp_path / "cache.json")).is_ingested(url)
+
+
+@pytest.mark.asyncio
+async def test_downloader_skips_unchanged_content(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def handler(request):
+        # сервер без поддержки условных запросов
+        return web.Response(body=b"xls-content")
+
+    server = await stub_server(handler)
+    url = str(server.make_url("/oil_xls_20250801162000.xls"))
+    downloader = main.Downloader(cache=main.DownloadCache(str(tmp_path / "cache.json")))
+    async with downloader.session() as session:
+        assert await download_files(session, url, downloader) == "oil_xls_20250801162000.xls"
+        downloader.cache.mark_ingested(url)
+        assert await download_files(session, url, downloader) is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_in_memory_without_file(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    body = bytes(range(256)) * 1024
+
+    async def handler(request):
+        return web.Response(body=body)
+
+    server = await stub_server(handler)
+    downloader = main.Downloader(keep_files=False, chunk_size=1024, max_chunk_size=16 * 1024)
+    async with downloader.session() as session:
+        filename, content = await main.fetch_file(session, str(server.make_url("/oil_xls_20250801162000.xls")),
+                                                  downloader)
+
+    assert filename == "oil_xls_20250801162000.xls"
+    assert content == body
+    assert not (tmp_path / filename).exists()
+    assert downloader.stats["bytes"] == len(body)
+
+
+@pytest.mark.asyncio
+async def test_warm_up_cache(monkeypatch):
+    import fakeredis
+    import app as api
+
+    fake_redis = fakeredis.FakeAsyncRedis()
+    await fake_redis.zadd(main.ACCESS_STATS_KEY, {"/dynamics?start_date=2025-07-01&end_date=2025-07-31": 5,
+                                                  "/results?oil_id=A100": 1})
+
+    async def connect():
+        api.redis = fake_redis
+
+    async def close():
+        api.redis = None
+
+    mock_get_dynamics = AsyncMock(return_value=[])
+    monkeypatch.setattr(api, "connect_redis", connect)
+    monkeypatch.setattr(api, "close_redis", close)
+    monkeypatch.setattr(api, "get_last_trading_date", AsyncMock(return_value=datetime.date(2025, 7, 3)))
+    monkeypatch.setattr(api, "get_trading_results", AsyncMock(return_value=[]))
+    monkeypatch.setattr(api, "get_dynamics", mock_get_dynamics)
+    monkeypatch.setattr(main, "CACHE_WARMUP_PATHS", ("/last_results",))
+
+    await main.warm_up_cache(top=1)
+
+    # постоянные запросы и самый частый из статистики, с ключами как у обычных запросов
+    cached_keys = [c.args[0] for c in api.set_cache.await_args_list]
+    assert cached_keys == ["last_results", "dynamics:2025-07-01:2025-07-31:None:None:None:None"]
+    mock_get_dynamics.assert_awaited_once()
+    # запросы прогрева не накручивают статистику, а старые счётчики ослабевают
+    assert not api.access_stats
+    assert await fake_redis.zrange(main.ACCESS_STATS_KEY, 0, -1, withscores=True) == [
+        (b"/dynamics?start_date=2025-07-01&end_date=2025-07-31", 2.5)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_download_cache_flush_is_throttled(tmp_path):
+    path = tmp_path / "cache.json"
+    cache = main.DownloadCache(str(path), flush_interval=60)
+    cache.update("u1", sha256="a")
+    cache.mark_ingested("u1")
+    # изменения не пишутся на каждый вызов
+    assert not path.exists()
+
+    await cache.flush(force=False)
+    assert not path.exists()
+    await cache.flush()
+    assert main.DownloadCache(str(path)).is_ingested("u1")
+    assert not cache.dirty